@@ -20,6 +20,7 @@
 #   You should have received a copy of the GNU General Public License
 #   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import numpy as np
 from casadi import *
 from casadi.tools import *
@@ -92,6 +93,157 @@ class EKF(Estimator):
         assert self.flags['setup'] == True, 'EKF was not setup yet. Please call EKF.setup().'
         None
 
+class MeasurementBuffer:
+    """Fixed-size ring buffer of the last ``n_horizon`` measurements, used by the default measurement function of the :py:class:`MHE`.
+
+    Each measurement is written twice into an array with ``2*n_horizon`` rows, such that appending takes constant time
+    and the last ``n_horizon`` measurements are always a contiguous view (oldest measurement first).
+    Until ``n_horizon`` measurements are available, the missing (older) entries are filled with the first measurement.
+
+    :param n_horizon: Number of stored measurements.
+    :type n_horizon: int
+
+    :param n_y: Number of elements of each measurement.
+    :type n_y: int
+    """
+    def __init__(self, n_horizon, n_y):
+        self.n_horizon = n_horizon
+        self.buffer = np.zeros((2*n_horizon, n_y))
+        self.reset()
+
+    def reset(self):
+        """Remove all measurements from the buffer.
+        """
+        self.buffer[:] = 0
+        self.i = 0 # Position of the oldest measurement.
+        self.count = 0 # Number of appended measurements.
+
+    def append(self, y):
+        """Append the most recent measurement ``y``.
+        """
+        y = np.asarray(y, dtype=float).reshape(-1)
+        if self.count == 0:
+            self.buffer[:] = y
+        else:
+            self.buffer[self.i] = y
+            self.buffer[self.i+self.n_horizon] = y
+            self.i = (self.i+1) % self.n_horizon
+        self.count += 1
+
+    @property
+    def window(self):
+        """Last ``n_horizon`` measurements (view with one row per measurement, oldest first).
+        """
+        return self.buffer[self.i:self.i+self.n_horizon]
+
+class ChunkedData(do_mpc.data.Data):
+    """**do-mpc** data container with preallocated storage, used by the :py:class:`MHE`.
+
+    The results of each data field are written row by row into chunks of ``chunk`` rows,
+    such that :py:func:`update` takes constant time however long the run is
+    (:py:class:`do_mpc.data.Data` copies the complete history at each update).
+    If a ``path`` is given, all but the last ``chunks_in_memory`` completed chunks of each field are spilled to disk
+    as ``.npy`` files (one file per chunk and field, use one directory per data object).
+
+    The fields are queried as for :py:class:`do_mpc.data.Data`, e.g. ``data['_x']`` or ``data._x``,
+    which concatenates the stored chunks.
+
+    :param model: Model of the estimator.
+    :type model: do_mpc.model.Model
+
+    :param chunk: Number of rows of each chunk.
+    :type chunk: int
+
+    :param path: Directory for the spilled chunks. Defaults to ``None`` (all chunks are kept in memory).
+    :type path: str
+
+    :param chunks_in_memory: Number of completed chunks of each field that are kept in memory if ``path`` is given.
+    :type chunks_in_memory: int
+    """
+    def __init__(self, model, chunk=1000, path=None, chunks_in_memory=1):
+        self.set_storage(chunk, path, chunks_in_memory)
+        super().__init__(model)
+
+    def __getattr__(self, name):
+        # Only called if name is not a regular attribute: data fields are assembled from their chunks.
+        if name not in self.__dict__.get('data_fields', {}):
+            raise AttributeError(name)
+        parts = [np.load(file_i) for file_i in self._files.get(name, [])] + self._chunks.get(name, [])
+        if name in self._buffer:
+            parts.append(self._buffer[name][:self._n[name]])
+        if len(parts) == 0:
+            return np.empty((0, self.data_fields[name]))
+        return np.concatenate(parts, axis=0)
+
+    def set_storage(self, chunk=1000, path=None, chunks_in_memory=1):
+        """Configure the storage. Applies to the data stored after the next call of :py:func:`init_storage`.
+        See the class docstring for the parameters.
+        """
+        assert chunk >= 1, 'chunk must be a positive integer.'
+        assert chunks_in_memory >= 0, 'chunks_in_memory must be a non-negative integer.'
+        self.chunk = int(chunk)
+        self.path = path
+        self.chunks_in_memory = int(chunks_in_memory)
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def init_storage(self):
+        """Remove all stored results (including the spilled chunks).
+        Chunks are allocated at the first update of each data field.
+        """
+        for files in self.__dict__.get('_files', {}).values():
+            for file_i in files:
+                if os.path.exists(file_i):
+                    os.remove(file_i)
+        self._buffer = {}   # Current chunk of each field.
+        self._n = {}        # Rows written to the current chunk.
+        self._chunks = {}   # Completed chunks in memory (oldest first).
+        self._files = {}    # Completed chunks spilled to disk (oldest first).
+
+    def update(self, **kwargs):
+        """Update value(s) of the data structure with key word arguments.
+        These key word arguments must exist in the data fields of the data object.
+        Each value is written to the next row of the current chunk of its field.
+
+        :param kwargs: Arbitrary number of key word arguments for data fields that should be updated.
+        :type kwargs: casadi.DM or numpy.ndarray
+
+        :raises assertion: Keyword must be in existing data_fields.
+
+        :return: None
+        """
+        for key, value in kwargs.items():
+            assert key in self.data_fields.keys(), 'Cannot update non existing key {} in data object.'.format(key)
+            if type(value) == structure3.DMStruct:
+                value = value.cat
+            if type(value) == DM:
+                value = value.full()
+            if key not in self._buffer:
+                self._buffer[key] = np.empty((self.chunk, self.data_fields[key]))
+                self._n[key] = 0
+            elif self._n[key] == self.chunk:
+                self._complete_chunk(key)
+            self._buffer[key][self._n[key]] = np.reshape(value, -1)
+            self._n[key] += 1
+
+    def _complete_chunk(self, key):
+        """Private method to move the full current chunk of a field to the completed chunks
+        and spill the oldest completed chunk if there are more than ``chunks_in_memory``.
+        """
+        chunks = self._chunks.setdefault(key, [])
+        chunks.append(self._buffer[key])
+        if self.path is not None and len(chunks) > self.chunks_in_memory:
+            files = self._files.setdefault(key, [])
+            file_i = os.path.join(self.path, '{}_{:06d}.npy'.format(key, len(files)))
+            spilled = chunks.pop(0)
+            np.save(file_i, spilled)
+            files.append(file_i)
+            # The spilled array is reused as the next chunk:
+            self._buffer[key] = spilled
+        else:
+            self._buffer[key] = np.empty_like(self._buffer[key])
+        self._n[key] = 0
+
 class MHE(do_mpc.optimizer.Optimizer, Estimator):
     """Moving horizon estimator.
 
@@ -141,7 +293,7 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
             graph [fontname = "helvetica"];
             rankdir=LR;
 
-            subgraph cluster_main{
+            subgraph cluster_main {
                 node [fontname = "helvetica", shape=box, fontcolor="#404040", color="#707070"];
                 edge [fontname = "helvetica", color="#707070"];
 
@@ -199,6 +351,10 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         Estimator.__init__(self, model)
         do_mpc.optimizer.Optimizer.__init__(self)
 
+        # Preallocated (chunked) storage of the results:
+        self.data = ChunkedData(model)
+        self.data.dtype = 'Estimator'
+
         # Initialize structure to hold the optimial solution and initial guess:
         self._opt_x_num = None
         # Initialize structure to hold the parameters for the optimization problem:
@@ -217,8 +373,14 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
             'nl_cons_single_slack',
             'cons_check_colloc_points',
             'store_full_solution',
+            'store_full_solution_every',
             'store_lagr_multiplier',
             'store_solver_stats',
+            'storage_chunk',
+            'storage_path',
+            'storage_chunks_in_memory',
+            'nlp_expand',
+            'nlp_jit',
             'nlpsol_opts'
         ]
 
@@ -232,13 +394,22 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         self.nl_cons_single_slack = False
         self.cons_check_colloc_points = True
         self.store_full_solution = False
+        self.store_full_solution_every = 1
         self.store_lagr_multiplier = True
         self.store_solver_stats = [
             'success',
             't_wall_total',
         ]
+        self.storage_chunk = 1000
+        self.storage_path = None
+        self.storage_chunks_in_memory = 1
+        self.nlp_expand = False
+        self.nlp_jit = False
         self.nlpsol_opts = {} # Will update default options with this dict.
 
+        # Number of calls of make_step (since the last reset of the history):
+        self._n_steps = 0
+
 
         # Create seperate structs for the estimated and the set parameters (the union of both are all parameters of the model.)
         _p = model._p
@@ -590,14 +761,32 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         :param store_full_solution: Choose whether to store the full solution of the optimization problem. This is required for animating the predictions in post processing. However, it drastically increases the required storage. Defaults to False.
         :type store_full_solution: bool
 
+        :param store_full_solution_every: If ``store_full_solution`` is ``True``, store the full solution only at every k-th call of :py:func:`make_step` (starting with the first). Use :py:func:`store_solution` to store further solutions on demand. Defaults to ``1``.
+        :type store_full_solution_every: int
+
         :param store_lagr_multiplier: Choose whether to store the lagrange multipliers of the optimization problem. Increases the required storage. Defaults to ``True``.
         :type store_lagr_multiplier: bool
 
         :param store_solver_stats: Choose which solver statistics to store. Must be a list of valid statistics. Defaults to ``['success','t_wall_S']``.
         :type store_solver_stats: list
 
-        :param nlpsol_opts: Dictionary with options for the CasADi solver call ``nlpsol`` with plugin ``ipopt``. All options are listed `here <http://casadi.sourceforge.net/api/internal/d4/d89/group__nlpsol.html>`_.
-        :type store_solver_stats: dict
+        :param storage_chunk: The results are stored in preallocated chunks with this number of rows (see :py:class:`ChunkedData`). Defaults to ``1000``.
+        :type storage_chunk: int
+
+        :param storage_path: Directory to which older chunks of the results are spilled as ``.npy`` files. Defaults to ``None`` (results are kept in memory).
+        :type storage_path: str
+
+        :param storage_chunks_in_memory: Number of completed chunks of each result that are kept in memory if ``storage_path`` is set. Defaults to ``1``.
+        :type storage_chunks_in_memory: int
+
+        :param nlp_expand: Expand the NLP to SX (scalar) expressions before creating the solver. Only has an effect for models with ``symvar_type='MX'``, which are otherwise evaluated as MX graphs. Defaults to ``False``.
+        :type nlp_expand: bool
+
+        :param nlp_jit: Compile the NLP functions (objective, constraints and their derivatives) to C code with the system compiler when the solver is created. This increases the setup time (seconds to minutes). Defaults to ``False``.
+        :type nlp_jit: bool
+
+        :param nlpsol_opts: Dictionary with options for the CasADi solver call ``nlpsol`` with plugin ``ipopt``. All options are listed `here <http://casadi.sourceforge.net/api/internal/d4/d89/group__nlpsol.html>`_. The options update the default options (including those set by ``nlp_expand`` and ``nlp_jit``).
+        :type nlpsol_opts: dict
 
         .. note:: We highly suggest to change the linear solver for IPOPT from `mumps` to `MA27`. In many cases this will drastically boost the speed of **do-mpc**. Change the linear solver with:
 
@@ -911,24 +1100,18 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         .. note::
             The structure is ordered, sucht that ``k=0`` is the "oldest measurement" and ``k=N_horizon`` is the newest measurement.
 
-        By default, the following measurement function is choosen:
+        By default (with ``meas_from_data=True``), the following measurement function is choosen:
 
         ::
 
             y_template = self.get_y_template()
 
             def y_fun(t_now):
-                n_steps = min(self.data._y.shape[0], self.n_horizon)
-                for k in range(-n_steps,0):
-                    y_template['y_meas',k] = self.data._y[k]
-                try:
-                    for k in range(self.n_horizon-n_steps):
-                        y_template['y_meas',k] = self.data._y[-n_steps]
-                except:
-                    None
+                y_template.master = DM(self._y_buffer.window.reshape(-1))
                 return y_template
 
-        Which simply reads the last results from the ``MHE.data`` object.
+        Which simply reads the last measurements passed to :py:func:`make_step` from a fixed-size
+        :py:class:`MeasurementBuffer` (the missing measurements of the first steps are filled with the first measurement).
 
         :return: y_template
         :rtype: struct_symSX
@@ -989,19 +1172,16 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
             def p_fun(t): return _p
             self.set_p_fun(p_fun)
 
+        # Fixed-size buffer of the last measurements (for the default measurement function).
+        self._y_buffer = MeasurementBuffer(self.n_horizon, self.model.n_y)
+
         if self.flags['set_y_fun'] == False and self.meas_from_data:
             # Case that measurement function is automatically created.
+            # The last measurements are read from the ring buffer that is filled in make_step.
             y_template = self.get_y_template()
 
             def y_fun(t_now):
-                n_steps = min(self.data._y.shape[0], self.n_horizon)
-                for k in range(-n_steps,0):
-                    y_template['y_meas',k] = self.data._y[k]
-                try:
-                    for k in range(self.n_horizon-n_steps):
-                        y_template['y_meas',k] = self.data._y[-n_steps]
-                except:
-                    None
+                y_template.master = DM(self._y_buffer.window.reshape(-1))
                 return y_template
             self.set_y_fun(y_fun)
         elif self.flags['set_y_fun'] == True:
@@ -1033,6 +1213,30 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
 
         self.flags['set_initial_guess'] = True
 
+    def reset_history(self):
+        """Reset the history of the MHE.
+        All data from the :py:class:`do_mpc.data.Data` instance and the buffered measurements are removed.
+        """
+        do_mpc.optimizer.Optimizer.reset_history(self)
+        self._n_steps = 0
+        if self.flags['setup']:
+            self._y_buffer.reset()
+
+    def store_solution(self):
+        """Store the full solution of the last call of :py:func:`make_step` in the data object.
+        The unscaled optimization variables, the auxiliary expressions and the index of the step are stored
+        in the fields ``_opt_x_num``, ``_opt_aux_num`` and ``_opt_k``.
+
+        This method is called by :py:func:`make_step` at every ``store_full_solution_every``-th step if ``store_full_solution`` is ``True``.
+        Use it to store further solutions on demand (also if ``store_full_solution`` is ``False``).
+        """
+        assert self._n_steps > 0, 'No solution to store. Please call make_step first.'
+        self.data.update(
+            _opt_x_num = self.opt_x_num_unscaled,
+            _opt_aux_num = self.opt_aux_num,
+            _opt_k = self._n_steps-1,
+        )
+
     def setup(self):
         """The setup method finalizes the MHE creation.
         The optimization problem is created based on the configuration of the module.
@@ -1086,6 +1290,7 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
             self.flags['set_initial_guess'] = True
 
         self.data.update(_y = y0)
+        self._y_buffer.append(y0)
 
 
         p_est0 = self._p_est0
@@ -1097,11 +1302,15 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
 
         y_traj = self.y_fun(t0)
 
-        self.opt_p_num['_x_prev'] = self.opt_x_num['_x', 1, -1]*self._x_scaling
-        self.opt_p_num['_p_est_prev'] = p_est0
-        self.opt_p_num['_p_set'] = p_set0
-        self.opt_p_num['_tvp'] = tvp0['_tvp']
-        self.opt_p_num['_y_meas'] = y_traj['y_meas']
+        # Assemble the parameter vector in the preallocated array (see index maps created in _prepare_nlp):
+        opt_p_val = self._opt_p_val
+        opt_p_ind = self._opt_p_ind
+        opt_p_val[opt_p_ind['_x_prev']] = self.opt_x_num.master.full()[self._opt_x_ind_x_prev, 0]*self._x_scaling_val
+        opt_p_val[opt_p_ind['_p_est_prev']] = p_est0.master.full()[:, 0]
+        opt_p_val[opt_p_ind['_p_set']] = p_set0.master.full()[:, 0]
+        opt_p_val[opt_p_ind['_tvp']] = tvp0.master.full()[self._tvp_ind, 0]
+        opt_p_val[opt_p_ind['_y_meas']] = y_traj.master.full()[:, 0]
+        self.opt_p_num.master = DM(opt_p_val)
 
         self.solve()
 
@@ -1115,21 +1324,21 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         p0 = self._p_cat_fun(p_est0, p_set0)
 
         # Update data object:
-        self.data.update(_x = x0)
-        self.data.update(_u = u0)
-        self.data.update(_z = z0)
-        self.data.update(_p = p0)
-        self.data.update(_tvp = tvp0['_tvp', -1])
-        self.data.update(_time = t0)
-        self.data.update(_aux = aux0)
+        self.data.update(
+            _x = x0,
+            _u = u0,
+            _z = z0,
+            _p = p0,
+            _tvp = tvp0['_tvp', -1],
+            _time = t0,
+            _aux = aux0,
+        )
 
         # Store additional information
+        self._n_steps += 1
         self.data.update(opt_p_num = self.opt_p_num)
-        if self.store_full_solution == True:
-            opt_x_num_unscaled = self.opt_x_num_unscaled
-            opt_aux_num = self.opt_aux_num
-            self.data.update(_opt_x_num = opt_x_num_unscaled)
-            self.data.update(_opt_aux_num = opt_aux_num)
+        if self.store_full_solution == True and (self._n_steps-1) % self.store_full_solution_every == 0:
+            self.store_solution()
         if self.store_lagr_multiplier == True:
             lam_g_num = self.lam_g_num
             self.data.update(_lam_g_num = lam_g_num)
@@ -1207,6 +1416,14 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         ])
         self.n_opt_p = opt_p.shape[0]
 
+        # Index maps and preallocated array to assemble the numerical values of opt_p in make_step:
+        self._opt_p_ind = {name: np.array(opt_p.f[name], dtype=int) for name in opt_p.keys()}
+        self._opt_p_val = np.zeros(self.n_opt_p)
+        self._opt_x_ind_x_prev = np.array(opt_x.f['_x', 1, -1], dtype=int)
+        self._x_scaling_val = self._x_scaling.cat.full()[:, 0]
+        # The tvp template has n_horizon+1 elements, the first n_horizon are used:
+        self._tvp_ind = np.arange(self._opt_p_ind['_tvp'].shape[0])
+
         # Dummy struct with symbolic variables
         self.aux_struct = self.model.sv.sym_struct([
             entry('_aux', repeat=[self.n_horizon], struct=self.model._aux_expression)
@@ -1349,6 +1566,20 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
         self.flags['prepare_nlp'] = True
 
 
+    def _prepare_data(self):
+        """Internal method. Extends the optimizer method such that full solutions can always be stored
+        on demand with :py:func:`store_solution` and configures the :py:class:`ChunkedData` storage.
+        """
+        self.data.set_storage(self.storage_chunk, self.storage_path, self.storage_chunks_in_memory)
+        self.data.data_fields.update({
+            '_opt_x_num': self.n_opt_x,
+            '_opt_aux_num': self.n_opt_aux,
+            '_opt_k': 1,
+        })
+        self.data.opt_x = self.opt_x
+        self.data.opt_aux = self.aux_struct
+        do_mpc.optimizer.Optimizer._prepare_data(self)
+
     def _create_nlp(self):
         """Internal method. See detailed documentation in optimizer.create_nlp
         """
@@ -1375,22 +1606,31 @@ class MHE(do_mpc.optimizer.Optimizer, Estimator):
 
 
         self.n_opt_lagr = self._nlp_cons.shape[0]
-        # Create casadi optimization object:
+        # Create casadi optimization object (the default options are updated with the user options):
         nlpsol_opts = {
-            'expand': False,
+            'expand': self.nlp_expand,
             'ipopt.linear_solver': 'mumps',
-        }.update(self.nlpsol_opts)
+        }
+        if self.nlp_jit:
+            nlpsol_opts.update({
+                'jit': True,
+                'compiler': 'shell',
+                'jit_options': {'flags': ['-O1'], 'verbose': False},
+            })
+        nlpsol_opts.update(self.nlpsol_opts)
         nlp = {'x': vertcat(self._opt_x), 'f': self._nlp_obj, 'g': self._nlp_cons, 'p': vertcat(self._opt_p)}
-        self.S = nlpsol('S', 'ipopt', nlp, self.nlpsol_opts)
+        self.S = nlpsol('S', 'ipopt', nlp, nlpsol_opts)
 
 
 
         # Create function to caculate all auxiliary expressions:
         self.opt_aux_expression_fun = Function('opt_aux_expression_fun', [self._opt_x, self._opt_p], [self._opt_aux])
+        if self.nlp_expand:
+            self.opt_aux_expression_fun = self.opt_aux_expression_fun.expand()
 
         # Gather meta information:
         meta_data = {key: getattr(self, key) for key in self.data_fields}
         self.data.set_meta(**meta_data)
 
         self._prepare_data()
-        self.flags['setup'] = True
\ No newline at end of file
+        self.flags['setup'] = True
@@ -0,0 +1,163 @@
+# Per-step solve time of the do-mpc MHE (MHE_do_source.py) of the Van de Vusse
+# reactor of mhe_do_mpc_vdv.py with the NLP built from SX or MX symbols, and
+# with the solver options nlp_expand (expand to SX) and nlp_jit (compiled NLP)
+
+import time
+import numpy as np
+from casadi import *
+import do_mpc
+from MHE_do_source import MHE
+
+
+def vdv_model(symvar_type='SX'):
+    """
+    do-mpc model of the Van de Vusse reactor (mhe_do_mpc_vdv.py)
+    """
+
+    model = do_mpc.model.Model('continuous', symvar_type)
+
+    # States, measurements and inputs
+    C_a = model.set_variable(var_type='_x', var_name='C_a', shape=(1,1))
+    C_b = model.set_variable(var_type='_x', var_name='C_b', shape=(1,1))
+    T_R = model.set_variable(var_type='_x', var_name='T_R', shape=(1,1))
+    T_K = model.set_variable(var_type='_x', var_name='T_K', shape=(1,1))
+    model.set_meas('C_b_1_meas', C_b, meas_noise=True)
+    model.set_meas('T_R_1_meas', T_R, meas_noise=True)
+    F = model.set_variable(var_type='_u', var_name='F')
+    Q_dot = model.set_variable(var_type='_u', var_name='Q_dot')
+    model.set_meas('F_meas', F, meas_noise=False)
+    model.set_meas('Q_dot', Q_dot, meas_noise=False)
+
+    # Constants and uncertain parameters
+    K0_ab = 1.287e12 # K0 [h^-1]
+    K0_bc = 1.287e12 # K0 [h^-1]
+    K0_ad = 9.043e9 # K0 [l/mol.h]
+    E_A_ab = 9758.3 # [kj/mol]
+    E_A_bc = 9758.3 # [kj/mol]
+    E_A_ad = 8560.0 # [kj/mol]
+    H_R_ab = 4.2 # [kj/mol A]
+    H_R_bc = -11.0 # [kj/mol B] Exothermic
+    H_R_ad = -41.85 # [kj/mol A] Exothermic
+    Rou = 0.9342 # Density [kg/l]
+    Cp = 3.01 # Specific Heat capacity [kj/Kg.K]
+    Cp_k = 2.0 # Coolant heat capacity [kj/kg.k]
+    A_R = 0.215 # Area of reactor wall [m^2]
+    V_R = 10.0 # Volume of reactor [l]
+    m_k = 5.0 # Coolant mass[kg]
+    T_in = 135.0 # Temp of inflow [Celsius]
+    K_w = 4032.0 # [kj/h.m^2.K]
+    C_A0 = 5.1 # Concentration of A in input  [mol/l]
+    alpha = model.set_variable(var_type='parameter', var_name='alpha')
+    beta = model.set_variable(var_type='parameter', var_name='beta')
+    gamma = model.set_variable(var_type='parameter', var_name='gamma')
+
+    # ODE system
+    K_1 = gamma * K0_ab * exp((-E_A_ab)/((T_R+273.15)))
+    K_2 = K0_bc * exp((-E_A_bc)/((T_R+273.15)))
+    K_3 = K0_ad * exp((-E_A_ad)/((T_R+273.15)))
+    T_dif = model.set_expression(expr_name='T_dif', expr=T_R-T_K)
+    model.set_rhs('C_a', F*(alpha*C_A0 - C_a) -K_1*C_a - K_3*(C_a**2))
+    model.set_rhs('C_b', -F*C_b + K_1*C_a - K_2*C_b)
+    model.set_rhs('T_R', ((K_1*C_a*H_R_ab + K_2*C_b*H_R_bc + K_3*(C_a**2)*H_R_ad)/(-Rou*beta*Cp)) + F*(T_in-T_R) + (((K_w*A_R)*(-T_dif))/(Rou*beta*Cp*V_R)))
+    model.set_rhs('T_K', (Q_dot + K_w*A_R*(T_dif))/(m_k*Cp_k))
+    model.setup()
+    return model
+
+
+# Wall times of the NLP function evaluations in the solver statistics
+nlp_stats = ['t_wall_nlp_f', 't_wall_nlp_g', 't_wall_nlp_grad_f', 't_wall_nlp_hess_l', 't_wall_nlp_jac_g']
+
+
+def build_mhe(model, x0, u0, **params):
+    """
+    MHE of mhe_do_mpc_vdv.py (params update the settings)
+    """
+
+    mhe = MHE(model, ['alpha', 'beta', 'gamma'])
+    setup_mhe = {
+        't_step': 0.005,
+        'n_horizon': 10,
+        'meas_from_data': True,
+        'store_lagr_multiplier': False,
+        'store_solver_stats': ['iter_count'] + nlp_stats,
+        'nlpsol_opts': {'ipopt.print_level': 0, 'ipopt.sb': 'yes', 'print_time': 0},
+    }
+    setup_mhe.update(params)
+    mhe.set_param(**setup_mhe)
+    mhe.set_default_objective(np.eye(4), np.diag(np.array([1, 1])), 6*np.eye(3))
+    mhe.scaling['_x', 'T_R'] = 100
+    mhe.scaling['_x', 'T_K'] = 100
+    mhe.scaling['_u', 'Q_dot'] = 2000
+    mhe.scaling['_u', 'F'] = 100
+    mhe.bounds['lower', '_x', 'C_a'] = 0.1
+    mhe.bounds['lower', '_x', 'C_b'] = 0.1
+    mhe.bounds['lower', '_x', 'T_R'] = 50
+    mhe.bounds['lower', '_x', 'T_K'] = 50
+    mhe.bounds['upper', '_x', 'C_a'] = 2
+    mhe.bounds['upper', '_x', 'C_b'] = 2
+    mhe.bounds['upper', '_x', 'T_K'] = 140
+    mhe.bounds['lower', '_u', 'F'] = 5
+    mhe.bounds['lower', '_u', 'Q_dot'] = -8500
+    mhe.bounds['upper', '_u', 'F'] = 100
+    mhe.bounds['upper', '_u', 'Q_dot'] = 0.0
+    for name in ['alpha', 'beta', 'gamma']:
+        mhe.bounds['lower', '_p_est', name] = 0.5
+        mhe.bounds['upper', '_p_est', name] = 1.5
+    mhe.setup()
+    mhe.x0 = x0
+    mhe.p_est0 = np.array([1, 1, 1])
+    mhe.u0 = u0
+    mhe.set_initial_guess()
+    return mhe
+
+
+def measurements(nsteps, x0, u0, seed=0):
+    """
+    Noisy measurements of the simulated plant (the same for every MHE)
+    """
+
+    simulator = do_mpc.simulator.Simulator(vdv_model())
+    simulator.set_param(integration_tool='cvodes', abstol=1e-10, reltol=1e-10, t_step=0.005)
+    p_template = simulator.get_p_template()
+
+    def p_fun(t_now):
+        p_template['alpha'] = 1
+        p_template['beta'] = 1
+        p_template['gamma'] = 1
+        return p_template
+    simulator.set_p_fun(p_fun)
+    simulator.setup()
+    simulator.x0 = x0
+    rng = np.random.default_rng(seed)
+    noise = np.array([[1e-3], [0.05], [0], [0]])
+    y = []
+    for k in range(0, nsteps):
+        y.append(simulator.make_step(u0*(1 + 0.2*np.sin(k/20))) + noise*rng.normal(size=(4, 1)))
+    return y
+
+
+if __name__ == '__main__':
+    nsteps = 200
+    x0 = np.array([0.8, 0.5, 134.14, 130.0]).reshape(-1,1)
+    u0 = np.array([10, -1]).reshape(-1,1)
+    y = measurements(nsteps, x0, u0)
+    x_ref = None
+    for symvar_type in ['SX', 'MX']:
+        model = vdv_model(symvar_type)
+        for expand, jit in [(False, False), (True, False), (False, True), (True, True)]:
+            tic = time.perf_counter()
+            mhe = build_mhe(model, x0, u0, nlp_expand=expand, nlp_jit=jit)
+            t_setup = time.perf_counter() - tic
+            x_est = []
+            t_step = []
+            for y_k in y:
+                tic = time.perf_counter()
+                x_est.append(mhe.make_step(y_k).ravel())
+                t_step.append(time.perf_counter() - tic)
+            x_est = np.array(x_est)
+            x_ref = x_est if x_ref is None else x_ref
+            t_nlp = np.sum([mhe.data[stat] for stat in nlp_stats], axis=0).ravel()
+            print('%s expand=%-5s jit=%-5s: setup %4.1f s, step %5.2f ms (NLP functions %5.2f ms, '
+                  '%4.1f iterations), max. difference of the estimates %.1e'
+                  % (symvar_type, expand, jit, t_setup, 1e3*np.median(t_step), 1e3*np.median(t_nlp),
+                     np.mean(mhe.data['iter_count']), np.max(np.abs(x_est - x_ref))))
@@ -0,0 +1,178 @@
+# Monte Carlo closed-loop campaigns of the main.py scenario (noise seeds,
+# plant/model mismatch and disturbance profiles) run in a process pool
+
+import contextlib
+import functools
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import Scenario
+
+# Solvers built once in each worker
+_solvers = {}
+
+
+def step_profile(n, t1=0.25, t2=0.5, cain=5.1, tin=143):
+    """
+    Disturbance profile of main.py with variable steps: Cain steps at t1 and
+    Tin at t2 (n and t1, t2 are fractions of the simulation)
+    """
+
+    if n > t1 and n < t2:
+        return [cain, 130]
+    elif n >= t2:
+        return [cain, tin]
+    else:
+        return [4, 130]
+
+
+def make_runs(n, seed=0, par_spread=0.2, dist=True):
+    """
+    Runs of a campaign, each drawn from its own seed spawned from seed, so
+    the campaign does not depend on how runs are spread over the workers
+    """
+
+    runs = []
+    for i, ss in enumerate(np.random.SeedSequence(seed).spawn(n)):
+        rng = np.random.default_rng(ss)
+        mismatch = 1 + par_spread*rng.uniform(-1, 1, 2)
+        run = {
+            'run': i,
+            'seed': int(rng.integers(2**32)),
+            'par_plant': [float(v) for v in np.array(Scenario.par_model)*mismatch],
+            'dist': {}
+        }
+        if dist:
+            run['dist'] = {'t1': float(rng.uniform(0.15, 0.35)), 't2': float(rng.uniform(0.4, 0.6)),
+                           'cain': float(rng.uniform(4.5, 5.5)),
+                           'tin': float(130*rng.uniform(1, 1.15))}
+        runs.append(run)
+    return runs
+
+
+def init_worker(mhe_kwargs={}, nmpc_kwargs={}):
+    """
+    Builds the plant, MHE and NMPC of a worker
+    """
+
+    _solvers['process'] = Scenario.build_process()
+    _solvers['mhe'] = Scenario.build_mhe(**mhe_kwargs)
+    _solvers['nmpc'] = Scenario.build_nmpc(**nmpc_kwargs)
+
+
+def run_one(run, tsim=2):
+    """
+    Runs the closed loop of one campaign run with the solvers of the worker
+    """
+
+    if not _solvers:
+        init_worker()
+    mhe = _solvers['mhe']
+    nmpc = _solvers['nmpc']
+    mhe.reset()
+    nmpc.reset()
+    with contextlib.redirect_stdout(io.StringIO()):  # mute the step messages
+        res = Scenario.run_closed_loop(_solvers['process'], mhe, nmpc, tsim=tsim,
+                                       seed=run['seed'], par_plant=run['par_plant'],
+                                       disturbance=functools.partial(step_profile, **run['dist']))
+    rmse = np.sqrt(np.mean((res['x_est'] - res['y'])**2, axis=0))
+    mhe_stats = mhe.telemetry.data
+    nmpc_stats = nmpc.telemetry.data
+    # the advanced-step NLP is solved in the background: only its correction has the budget
+    tmax = np.inf if nmpc.tmax is None or nmpc.advanced_step else nmpc.tmax
+    nmpc_late = nmpc_stats['success'] & (nmpc_stats['t_wall'] > tmax)
+    return dict({
+        'run': run['run'],
+        'k01_plant': run['par_plant'][0],
+        'cp_plant': run['par_plant'][1],
+        'mhe_fail': int(np.sum(~mhe_stats['success'])),
+        'nmpc_fail': int(np.sum(~nmpc_stats['success'])),
+        'nmpc_timeout': int(np.sum(nmpc_late)),  # converged after tmax (shifted plan applied)
+        'rmse_Cb_est': rmse[1],
+        'rmse_T_est': rmse[2]
+    }, **Scenario.performance(res))
+
+
+class RunningStats:
+    """
+    Incremental mean, standard deviation, minimum and maximum of every
+    numeric field of the campaign rows (Welford)
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = {}
+        self.m2 = {}
+        self.min = {}
+        self.max = {}
+
+    def update(self, row):
+        """
+        Adds one run
+        """
+
+        self.n += 1
+        for key, v in row.items():
+            if key == 'run':
+                continue
+            v = float(v)
+            if key not in self.mean:
+                self.mean[key], self.m2[key], self.min[key], self.max[key] = 0.0, 0.0, v, v
+            delta = v - self.mean[key]
+            self.mean[key] += delta/self.n
+            self.m2[key] += delta*(v - self.mean[key])
+            self.min[key] = min(self.min[key], v)
+            self.max[key] = max(self.max[key], v)
+
+    def summary(self):
+        """
+        Statistics per field
+        """
+
+        return {key: {
+            'mean': self.mean[key],
+            'std': np.sqrt(self.m2[key]/(self.n - 1)) if self.n > 1 else 0.0,
+            'min': self.min[key],
+            'max': self.max[key]
+        } for key in self.mean}
+
+    def print(self):
+        """
+        Prints the statistics as a table
+        """
+
+        print('%d runs' % self.n)
+        print('%14s | %12s | %12s | %12s | %12s' % ('', 'mean', 'std', 'min', 'max'))
+        for key, s in self.summary().items():
+            print('%14s | %12.4g | %12.4g | %12.4g | %12.4g' % (key, s['mean'], s['std'],
+                                                                 s['min'], s['max']))
+
+
+def campaign(runs, tsim=2, nproc=None, mhe_kwargs={}, nmpc_kwargs={}, verbose=True):
+    """
+    Runs the campaign in a process pool (solvers built once per worker) and
+    aggregates the statistics as the runs finish. Returns the statistics and
+    the rows sorted by run
+    """
+
+    nproc = os.cpu_count() if nproc is None else nproc
+    stats = RunningStats()
+    rows = []
+    with ProcessPoolExecutor(max_workers=nproc, initializer=init_worker,
+                             initargs=(mhe_kwargs, nmpc_kwargs)) as pool:
+        jobs = [pool.submit(run_one, run, tsim) for run in runs]
+        for job in as_completed(jobs):
+            row = job.result()
+            rows.append(row)
+            stats.update(row)
+            if verbose and (stats.n % max(len(runs)//10, 1) == 0 or stats.n == len(runs)):
+                print('%d/%d runs, mean IAE_Cb %.4f' % (stats.n, len(runs), stats.mean['IAE_Cb']))
+    return stats, sorted(rows, key=lambda r: r['run'])
+
+
+if __name__ == '__main__':
+    runs = make_runs(500, seed=0)
+    stats, rows = campaign(runs, tsim=2, mhe_kwargs={'N': 10, 'arrival': True,
+                                                     'disc': 'multiple_shooting'})
+    stats.print()
@@ -1,7 +1,342 @@
 import copy
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from casadi import *
 
 
+# NLP solver backends: nlpsol plugin, QP solver (SQP only) and default options
+BACKENDS = {
+    'ipopt': {'plugin': 'ipopt', 'qpsol': None, 'opts': {}},
+    'sqp_qrqp': {'plugin': 'sqpmethod', 'qpsol': 'qrqp',
+                 'opts': {'qpsol_options': {'print_iter': False, 'print_header': False,
+                                            'error_on_fail': False}}},
+    'sqp_qpoases': {'plugin': 'sqpmethod', 'qpsol': 'qpoases',
+                    'opts': {'qpsol_options': {'printLevel': 'none', 'error_on_fail': False}}},
+    'sqp_osqp': {'plugin': 'sqpmethod', 'qpsol': 'osqp',
+                 'opts': {'qpsol_options': {'osqp': {'verbose': False}, 'error_on_fail': False}}},
+}
+
+
+def available_backends():
+    """
+    Lists the backends whose plugins are available in the installed casadi
+    """
+
+    return [name for name, b in BACKENDS.items() if has_nlpsol(b['plugin']) and
+            (b['qpsol'] is None or has_conic(b['qpsol']))]
+
+
+def backend_opts(backend='ipopt', hessian='exact', opts={}, tmax=None):
+    """
+    Merges the backend defaults, the Hessian option ('exact' or
+    'limited-memory') and the time limits (s, IPOPT only) into the user
+    nlpsol options. Options of other plugins (e.g. the 'ipopt' dict) are
+    dropped
+    """
+
+    b = BACKENDS[backend]
+    plugins = set(v['plugin'] for v in BACKENDS.values()) - {b['plugin']}
+    opts = {k: v for k, v in opts.items() if k.split('.')[0] not in plugins}
+    for k, v in b['opts'].items():
+        opts[k] = dict(v, **opts.get(k, {})) if isinstance(v, dict) else opts.get(k, v)
+
+    if b['plugin'] == 'ipopt':
+        extra = {'hessian_approximation': hessian}
+        if tmax is not None:
+            extra.update(max_wall_time=tmax, max_cpu_time=tmax)
+        opts['ipopt'] = dict(opts.get('ipopt', {}), **extra)
+    elif b['plugin'] == 'sqpmethod':
+        opts['qpsol'] = b['qpsol']
+        opts['hessian_approximation'] = hessian
+        opts.setdefault('print_header', False)
+        opts.setdefault('print_iteration', False)
+        opts.setdefault('print_status', False)
+    return opts
+
+
+def matrix_sqrt(W):
+    """
+    Symmetric square root of a positive semidefinite weight matrix
+    """
+
+    lam, V = np.linalg.eigh(np.atleast_2d(np.asarray(W, dtype=float)))
+    return V @ np.diag(np.sqrt(np.clip(lam, 0, None))) @ V.T
+
+
+def gauss_newton_hessian(nlp, r, fq=0, triu_only=True):
+    """
+    Gauss-Newton Hessian of the Lagrangian of an NLP whose objective is
+    r'r + fq: 2*Jr'Jr plus the exact Hessian of fq (e.g. an arrival cost),
+    without the second derivatives of r and of the constraints
+    """
+
+    w = nlp['x']
+    lam_f = MX.sym('lam_f')
+    lam_g = MX.sym('lam_g', nlp['g'].shape[0] if 'g' in nlp else 0)
+    Jr = jacobian(r, w)
+    H = 2*mtimes(Jr.T, Jr)
+    if not (isinstance(fq, (int, float)) and fq == 0):
+        H += hessian(fq, w)[0]
+    H = lam_f*(triu(H) if triu_only else H)
+    return Function('nlp_hess_l', [w, nlp['p'], lam_f, lam_g], [H],
+                    ['x', 'p', 'lam_f', 'lam_g'], ['hess_gamma_x_x'])
+
+
+def nlp_solver(nlp, backend='ipopt', hessian='exact', opts={}, tmax=None, residual=None,
+               scale=None, log_index=()):
+    """
+    Builds the NLP solver for the chosen backend. hessian='gauss-newton'
+    needs residual = (r, fq) with the objective equal to r'r + fq. With
+    scale (one value per decision variable) or log_index, the NLP is solved
+    scaled (see ScaledSolver)
+    """
+
+    if scale is not None or len(log_index) > 0:  # Hessian built on the scaled NLP
+        return ScaledSolver(nlp, scale, log_index, backend, hessian, opts, tmax, residual)
+
+    if hessian == 'gauss-newton':
+        if residual is None:
+            raise ValueError('The Gauss-Newton Hessian needs the residual vector.')
+        triu_only = BACKENDS[backend]['plugin'] == 'ipopt'
+        opts = dict(opts, hess_lag=gauss_newton_hessian(nlp, *residual, triu_only=triu_only))
+        hessian = 'exact'
+
+    return nlpsol('solver', BACKENDS[backend]['plugin'], nlp,
+                  backend_opts(backend, hessian, opts, tmax))
+
+
+def variable_scale(w0, lbw, ubw, mode='bounds'):
+    """
+    Scale of each decision variable: the largest finite bound magnitude
+    ('bounds') or the magnitude of the initial guess ('nominal'), falling
+    back on the guess and then on 1
+    """
+
+    if mode not in ('bounds', 'nominal'):
+        raise ValueError("scaling must be 'bounds' or 'nominal'")
+    vec = lambda v: np.array(vertcat(*v) if isinstance(v, list) else DM(v), dtype=float).ravel()
+    w0 = np.abs(vec(w0))
+    s = w0.copy()
+    if mode == 'bounds':
+        bounds = np.abs(np.vstack([vec(lbw), vec(ubw)]))
+        bounds[~np.isfinite(bounds)] = 0
+        s = np.where(bounds.max(axis=0) > 0, bounds.max(axis=0), w0)
+    return np.where(s > 0, s, 1.0)
+
+
+class ScaledSolver:
+    """
+    This class solves an NLP on scaled variables z (w = scale*z, or w = exp(z)
+    for the components in log_index) with the objective and each constraint
+    row divided by the infinity norm of their gradient in z at the first
+    initial guess. It is called like an nlpsol and returns unscaled results
+    (variables, constraints and multipliers)
+    """
+
+    def __init__(self, nlp, scale=None, log_index=(), backend='ipopt', hessian='exact', opts={},
+                 tmax=None, residual=None):
+        w = nlp['x']
+        p = nlp['p'] if 'p' in nlp else MX.sym('p', 0)
+        g = nlp['g'] if 'g' in nlp else MX.sym('g', 0)
+        self.nw = w.shape[0]
+        self.np = p.shape[0]
+        self.ng = g.shape[0]
+        self.scale = np.ones(self.nw) if scale is None else np.array(scale, dtype=float).ravel()
+        self.log = np.zeros(self.nw, dtype=bool)
+        self.log[list(log_index)] = True
+
+        # w as a function of z
+        z = MX.sym('z', self.nw)
+        lin = np.flatnonzero(~self.log)
+        log = np.flatnonzero(self.log)
+        wz = vertcat(DM(self.scale[lin])*z[list(lin)], exp(z[list(log)]))
+        wz = wz[list(np.argsort(np.concatenate([lin, log])))]
+        f = nlp['f'] if 'f' in nlp and nlp['f'].numel() > 0 else MX(0)  # empty: feasibility
+        outs = [f, g] + ([residual[0], MX(residual[1])] if residual is not None else [])
+        res = Function('nlp_w', [w, p], outs, {'always_inline': True})(wz, p)
+
+        # Scaled NLP (the objective and row factors are parameters)
+        sf = MX.sym('sf')
+        sg = MX.sym('sg', self.ng)
+        nlp_z = {'x': z, 'p': vertcat(p, sf, sg), 'f': sf*res[0], 'g': sg*res[1]}
+        residual_z = (sqrt(sf)*res[2], sf*res[3]) if residual is not None else None
+        self.solver = nlp_solver(nlp_z, backend, hessian, opts, tmax, residual_z)
+        self.grad = Function('grad_z', [z, p], [gradient(res[0], z), jacobian(res[1], z)])
+        self.sf = None
+        self.sg = None
+
+    def factors(self, z0, p):
+        """
+        Objective and constraint row factors at (z0, p)
+        """
+
+        gf, Jg = self.grad(z0, p)
+        self.sf = min(1, 100/max(float(norm_inf(gf)), 1e-8))
+        rows = np.array(Jg.sparsity().get_triplet()[0], dtype=int)
+        norm = np.zeros(self.ng)
+        np.maximum.at(norm, rows, np.abs(np.array(Jg.nonzeros())))
+        self.sg = 1/np.maximum(norm, 1)
+
+    def to_z(self, w, bound=False):
+        w = np.array(DM(w), dtype=float).ravel()*np.ones(self.nw)
+        z = w/self.scale
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z[self.log] = np.where(w[self.log] > 0, np.log(w[self.log]),
+                                   -inf if bound else np.log(1e-300))
+        return z
+
+    def __call__(self, x0=0, p=None, lbx=-inf, ubx=inf, lbg=None, ubg=None, lam_x0=None,
+                 lam_g0=None):
+        p = np.zeros(self.np) if p is None else np.array(DM(p), dtype=float).ravel()
+        z0 = self.to_z(x0)
+        if self.sf is None:
+            self.factors(z0, p)
+        args = {'x0': z0, 'p': np.concatenate([p, [self.sf], self.sg]),
+                'lbx': self.to_z(lbx, bound=True), 'ubx': self.to_z(ubx, bound=True)}
+        if lbg is not None:
+            args['lbg'] = np.array(DM(lbg), dtype=float).ravel()*self.sg
+        if ubg is not None:
+            args['ubg'] = np.array(DM(ubg), dtype=float).ravel()*self.sg
+        dwdz0 = np.where(self.log, np.exp(z0), self.scale)
+        if lam_x0 is not None:
+            args['lam_x0'] = np.array(DM(lam_x0), dtype=float).ravel()*dwdz0*self.sf
+        if lam_g0 is not None:
+            args['lam_g0'] = np.array(DM(lam_g0), dtype=float).ravel()*self.sf/self.sg
+        sol = self.solver(**args)
+
+        # Unscaled results
+        z = sol['x'].full().ravel()
+        w = np.where(self.log, np.exp(z), self.scale*z)
+        dwdz = np.where(self.log, w, self.scale)
+        return {
+            'x': DM(w),
+            'f': sol['f']/self.sf,
+            'g': DM(sol['g'].full().ravel()/self.sg),
+            'lam_x': DM(sol['lam_x'].full().ravel()/dwdz/self.sf),
+            'lam_g': DM(sol['lam_g'].full().ravel()*self.sg/self.sf),
+            'lam_p': sol['lam_p'][:self.np]/self.sf
+        }
+
+    def stats(self):
+        return self.solver.stats()
+
+
+class Telemetry:
+    """
+    Ring buffer with the statistics of the last solves of an NLP solver
+    (iterations, wall time and per-callback wall/CPU times and call counts).
+    'solver' is the wall time spent outside the callbacks, i.e. in the
+    solver itself (mostly linear algebra for IPOPT)
+    """
+
+    CALLBACKS = ('nlp_f', 'nlp_g', 'nlp_grad_f', 'nlp_jac_g', 'nlp_hess_l', 'nlp_jac_fg', 'QP')
+
+    def __init__(self, size=1000):
+        fields = [('iter', int), ('success', bool), ('t_wall', float), ('solver', float)]
+        for c in self.CALLBACKS:
+            fields += [('t_wall_' + c, float), ('t_proc_' + c, float), ('n_call_' + c, int)]
+        self.buffer = np.zeros(size, dtype=fields)
+        self.size = size
+        self.i = 0  # next position
+        self.count = 0  # solves recorded
+
+    def record(self, stats, t_wall):
+        """
+        Records the stats() of 1 solve that took t_wall seconds
+        """
+
+        row = self.buffer[self.i]
+        row['iter'] = stats.get('iter_count', 0)
+        row['success'] = stats.get('success', False)
+        row['t_wall'] = t_wall
+        tcall = 0
+        for c in self.CALLBACKS:
+            row['t_wall_' + c] = stats.get('t_wall_' + c, 0)
+            row['t_proc_' + c] = stats.get('t_proc_' + c, 0)
+            row['n_call_' + c] = stats.get('n_call_' + c, 0)
+            tcall += row['t_wall_' + c]
+        row['solver'] = max(t_wall - tcall, 0)
+        self.i = (self.i + 1) % self.size
+        self.count += 1
+
+    def reset(self):
+        """
+        Discards the recorded solves
+        """
+
+        self.i = 0
+        self.count = 0
+
+    @property
+    def data(self):
+        """
+        Recorded solves, oldest first
+        """
+
+        if self.count < self.size:
+            return self.buffer[:self.count]
+        return np.concatenate((self.buffer[self.i:], self.buffer[:self.i]))
+
+    def summary(self, q=(50, 90, 99)):
+        """
+        Mean, percentiles and maximum of the iterations and times, and share of
+        the total wall time of each callback and of the solver (only the
+        counts when nothing has been recorded)
+        """
+
+        data = self.data
+        if len(data) == 0:
+            return {'solves': 0, 'success_rate': 0}
+        keys = ['iter', 't_wall', 'solver'] + ['t_wall_' + c for c in self.CALLBACKS
+                                               if np.any(data['n_call_' + c])]
+        total = max(np.sum(data['t_wall']), 1e-12)
+        out = {'solves': len(data), 'success_rate': np.mean(data['success'])}
+        for k in keys:
+            v = data[k].astype(float)
+            out[k] = dict({'mean': np.mean(v), 'max': np.max(v), 'share': np.sum(v)/total},
+                          **{'p' + str(p): np.percentile(v, p) for p in q})
+        out['iter']['share'] = None
+        out['t_wall']['share'] = 1.0
+        return out
+
+    def histogram(self, key='t_wall', bins=10, width=40):
+        """
+        Text histogram of one field
+        """
+
+        v = self.data[key].astype(float)
+        counts, edges = np.histogram(v, bins=bins)
+        lines = []
+        for n, lo, hi in zip(counts, edges[:-1], edges[1:]):
+            bar = '#'*int(round(width*n/max(np.max(counts), 1)))
+            lines.append('%10.4g - %10.4g | %-*s %d' % (lo, hi, width, bar, n))
+        return '\n'.join(lines)
+
+    def report(self, bins=10):
+        """
+        Prints the summary and the histograms of the iterations and wall times
+        """
+
+        s = self.summary()
+        if s['solves'] == 0:
+            print('no solves recorded')
+            return
+        print('%d solves, success rate %.1f%%' % (s['solves'], 100*s['success_rate']))
+        print('%17s | %10s | %10s | %10s | %10s | %10s | %7s' % ('', 'mean', 'p50', 'p90', 'p99',
+                                                                 'max', 'share'))
+        for k, v in s.items():
+            if isinstance(v, dict):
+                share = '' if v['share'] is None else '%6.1f%%' % (100*v['share'])
+                print('%17s | %10.4g | %10.4g | %10.4g | %10.4g | %10.4g | %7s' %
+                      (k, v['mean'], v['p50'], v['p90'], v['p99'], v['max'], share))
+        print('\nIterations')
+        print(self.histogram('iter', bins))
+        print('\nWall time [s]')
+        print(self.histogram('t_wall', bins))
+
+
 class ODEModel:
     """
     This class creates an ODE model using casadi symbolic framework
@@ -9,12 +344,14 @@ class ODEModel:
 
     def __init__(self, dt, x, dx, J=None, y=None, u=None, d=None, p=None):
         self.dt = dt  # sampling
+        self.telemetry = Telemetry()  # solver statistics
         self.x = x  # states (sym)
-        self.y = MX.sym('y', 0) if y is None else y  # outputs (sym)
-        self.u = MX.sym('u', 0) if u is None else u  # inputs (sym)
-        self.d = MX.sym('d', 0) if d is None else d  # disturbances (sym)
-        self.p = MX.sym('p', 0) if p is None else p  # parameters (sym)
-        self.J = MX.sym('J', 0) if J is None else p  # cost function
+        sym = type(x).sym  # SX or MX, as the model
+        self.y = sym('y', 0) if y is None else y  # outputs (sym)
+        self.u = sym('u', 0) if u is None else u  # inputs (sym)
+        self.d = sym('d', 0) if d is None else d  # disturbances (sym)
+        self.p = sym('p', 0) if p is None else p  # parameters (sym)
+        self.J = sym('J', 0) if J is None else p  # cost function
         self.dx = dx  # model equations
         #self.theta = vertcat(self.d, self.p)  # parameters to be estimated vector (sym)
 
@@ -88,7 +425,8 @@ class ODEModel:
         }
 
     def build_nlp_steady(self, xguess=None, uguess=None, lbx=None, ubx=None,
-                         lbu=None, ubu=None, opts={}):
+                         lbu=None, ubu=None, opts={}, backend='ipopt', hessian='exact',
+                         scaling=None):
         """
         Builds steady-state optimization NLP
         """
@@ -129,7 +467,7 @@ class ODEModel:
         self.lbg += list(np.zeros(self.dx.shape[0]))
         self.ubg += list(np.zeros(self.dx.shape[0]))
 
-        nlp = {
+        self.nlp = {
             'x': vertcat(*self.w),
             'p': vertcat(self.d, self.p),
             'f': self.J,
@@ -137,7 +475,8 @@ class ODEModel:
         }
 
         # Solver
-        self.solver = nlpsol('solver', 'ipopt', nlp, opts)
+        scale = variable_scale(self.w0, self.lbw, self.ubw, scaling) if scaling else None
+        self.solver = nlp_solver(self.nlp, backend, hessian, opts, scale=scale)
 
     def optimize_steady(self, ksim=None, df=[], pf=[]):
         """
@@ -145,18 +484,21 @@ class ODEModel:
         """
 
         # Solver run
-        sol = self.solver(x0=vertcat(*self.w0), p=vertcat(df+pf),
-                          lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw),
-                          lbg=vertcat(*self.lbg), ubg=vertcat(*self.ubg))
+        self.args = dict(x0=vertcat(*self.w0), p=vertcat(df+pf),
+                         lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw),
+                         lbg=vertcat(*self.lbg), ubg=vertcat(*self.ubg))
+        tic = time.perf_counter()
+        sol = self.solver(**self.args)
         flag = self.solver.stats()
+        self.telemetry.record(flag, time.perf_counter() - tic)
 
         if ksim != None:
-            if flag['return_status'] != 'Solve_Succeeded':  # checks if optimization converged
+            if not flag['success']:  # checks if optimization converged
                 print('Optimization step ' + str(ksim) + ': Solver did not converge.')
             else:
                 print('Optimization step ' + str(ksim) + ': Optimal Solution Found.')
         else:
-            if flag['return_status'] != 'Solve_Succeeded':  # checks if optimization converged
+            if not flag['success']:  # checks if optimization converged
                 print('Optimization step: Solver did not converge.')
             else:
                 print('Optimization step: Optimal Solution Found.')
@@ -170,7 +512,8 @@ class ODEModel:
         }
 
     def build_nlp_dyn(self, N, M, xguess, uguess, lbx=None, ubx=None, lbu=None,
-                      ubu=None, m=3, pol='legendre', opts={}):
+                      ubu=None, m=3, pol='legendre', opts={}, backend='ipopt',
+                      hessian='exact', scaling=None):
         """
         Build dynamic optimization NLP
         """
@@ -217,6 +560,8 @@ class ODEModel:
         # "Lift" initial conditions
         xk = MX.sym('x0', self.x.shape[0])  # first point at each interval
         x0_sym = MX.sym('x0_par', self.x.shape[0])  # first point
+        d_sym = MX.sym('d_par', self.d.shape[0])
+        p_sym = MX.sym('p_par', self.p.shape[0])
         uk_prev = uguess
 
         # Empty NLP
@@ -269,7 +614,7 @@ class ODEModel:
                 xc = self.Ldot[0, i + 1] * xk  # expression for the state derivative at the collocation poin
                 for j in range(0, m):
                     xc += self.Ldot[j + 1, i + 1] * xki[j]
-                fi = self.F(xki[i], uk, self.d, self.p)  # model and cost function
+                fi = self.F(xki[i], uk, d_sym, p_sym)  # model and cost function
                 self.g += [self.dt * fi[0] - xc]  # model equality contraints reformulated
                 self.lbg += list(np.zeros(self.x.shape[0]))
                 self.ubg += list(np.zeros(self.x.shape[0]))
@@ -294,11 +639,13 @@ class ODEModel:
             'x': vertcat(*self.w),
             'f': self.J,
             'g': vertcat(*self.g),
-            'p': vertcat(x0_sym, self.d, self.p)
+            'p': vertcat(x0_sym, d_sym, p_sym)
         }
 
         # Solver
-        self.solver = nlpsol('solver', 'ipopt', self.nlp, opts)  # nlp solver construction
+        scale = variable_scale(self.w0, self.lbw, self.ubw, scaling) if scaling else None
+        self.solver = nlp_solver(self.nlp, backend, hessian, opts,
+                                 scale=scale)  # nlp solver construction
 
     def optimize_dyn(self, xf, df=[], pf=[], ksim=None):
         """
@@ -306,18 +653,21 @@ class ODEModel:
         """
 
         # Solver run
-        sol = self.solver(x0=vertcat(*self.w0), p=vertcat(xf, df, pf),
-                          lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw),
-                          lbg=vertcat(*self.lbg), ubg=vertcat(*self.ubg))
+        self.args = dict(x0=vertcat(*self.w0), p=vertcat(xf, df, pf),
+                         lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw),
+                         lbg=vertcat(*self.lbg), ubg=vertcat(*self.ubg))
+        tic = time.perf_counter()
+        sol = self.solver(**self.args)
         flag = self.solver.stats()
+        self.telemetry.record(flag, time.perf_counter() - tic)
 
         if ksim != None:
-            if flag['return_status'] != 'Solve_Succeeded':  # checks if optimization converged
+            if not flag['success']:  # checks if optimization converged
                 print('Optimization step ' + str(ksim) + ': Solver did not converge.')
             else:
                 print('Optimization step ' + str(ksim) + ': Optimal Solution Found.')
         else:
-            if flag['return_status'] != 'Solve_Succeeded':  # checks if optimization converged
+            if not flag['success']:  # checks if optimization converged
                 print('Optimization step: Solver did not converge.')
             else:
                 print('Optimization step: Optimal Solution Found.')
@@ -398,7 +748,9 @@ class LSE:
     """
 
     def __init__(self, F, R, x, y, u, theta, thetaguess=None, lbtheta=None,
-                 ubtheta=None, rootfinder=None, opts={}):
+                 ubtheta=None, rootfinder=None, opts={}, backend='ipopt', hessian='exact',
+                 scaling=None, log_theta=()):
+        self.telemetry = Telemetry()  # solver statistics
         self.x = x
         self.y = y
         self.u = u
@@ -410,6 +762,8 @@ class LSE:
         [:self.x.shape[0]]).T @ R @ (self.y - vcat(self.rfsolver(self.x0,
                                                                  self.u, self.theta))[
                                               :self.x.shape[0]])  # quadratic error cost function
+        r = matrix_sqrt(R) @ (self.y - vcat(self.rfsolver(self.x0, self.u, self.theta))
+                              [:self.x.shape[0]])  # residuals (J = r'r)
 
         # Guesses and bounds
         thetaguess = np.zeros(self.theta.shape[0]) if thetaguess is None else thetaguess
@@ -436,7 +790,10 @@ class LSE:
         }
 
         # Solver
-        self.solver = nlpsol('solver', 'ipopt', self.nlp, opts)  # nlp solver construction
+        self.residual = (r, 0)
+        scale = variable_scale(self.w0, self.lbw, self.ubw, scaling) if scaling else None
+        self.solver = nlp_solver(self.nlp, backend, hessian, opts, residual=self.residual,
+                                 scale=scale, log_index=log_theta)  # nlp solver construction
 
     def update_par(self, xf=None, uf=None, ymeas=None, ksim=None):
         """
@@ -448,18 +805,21 @@ class LSE:
         ymeas = np.zeros(self.y.shape[0]) if ymeas is None else ymeas
 
         # Solver run
-        sol = self.solver(x0=vertcat(*self.w0), p=vertcat(xf, uf, ymeas),
-                          lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw))
+        self.args = dict(x0=vertcat(*self.w0), p=vertcat(xf, uf, ymeas),
+                         lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw))
+        tic = time.perf_counter()
+        sol = self.solver(**self.args)
         flag = self.solver.stats()
+        self.telemetry.record(flag, time.perf_counter() - tic)
 
         if ksim != None:
-            if flag['return_status'] != 'Solve_Succeeded':  # checks if optimization converged
+            if not flag['success']:  # checks if optimization converged
                 print('Estimation step' + str(ksim) + ': Solver did not converge.')
             else:
                 print('Estimation step ' + str(ksim) + ': Optimal Solution Found.')
 
         else:
-            if flag['return_status'] != 'Solve_Succeeded':  # checks if optimization converged
+            if not flag['success']:  # checks if optimization converged
                 print('Estimation step: Solver did not converge.')
             else:
                 print('Estimation step: Optimal Solution Found.')
@@ -480,9 +840,11 @@ class NMPC:
     def __init__(self, dt, N, M, Q, W, x, u, c, d, p, dx, R=None, xguess=None,
                  uguess=None, lbx=None, ubx=None, lbu=None, ubu=None, lbdu=None,
                  ubdu=None, tgt=False, disc='collocation', m=3, pol='legendre', 
-                 DRTO=False, solver_opts={}):
+                 DRTO=False, blocks=None, tmax=None, backend='ipopt', hessian='exact',
+                 advanced_step=False, linsol='qr', scaling=None, solver_opts={}):
 
         self.dt = dt
+        self.telemetry = Telemetry()  # solver statistics
         self.dx = dx
         self.x = x
         self.c = c
@@ -496,6 +858,11 @@ class NMPC:
         self.pol = pol
         self.Q = Q
         self.W = W
+        self.tmax = tmax  # time budget of each call (s)
+        self.uplan = None  # last valid input plan
+
+        # Move blocking
+        self.set_blocks(blocks)
 
         # Target matrix R
         R = np.zeros((self.u.shape[0], self.u.shape[0])) if R is None else R
@@ -521,9 +888,10 @@ class NMPC:
         if None in ubdu: ubdu = np.array([-inf if v is None else v for v in ubdu])
 
         # Quadratic cost function
-        self.sp = MX.sym('SP', self.c.shape[0])
-        self.target = MX.sym('Target', self.u.shape[0])
-        self.uprev = MX.sym('u_prev', self.u.shape[0])
+        sym = type(self.x).sym  # SX or MX, as the model
+        self.sp = sym('SP', self.c.shape[0])
+        self.target = sym('Target', self.u.shape[0])
+        self.uprev = sym('u_prev', self.u.shape[0])
 
         J = (self.c - self.sp).T @ Q @ (self.c - self.sp) + (self.u - self.target).T \
             @ R @ (self.u - self.target) + (self.u - self.uprev).T @ W @ (self.u - self.uprev)
@@ -533,8 +901,8 @@ class NMPC:
 
         # Check if the setpoints and targets are trajectories
         if not DRTO:
-            spk = self.sp
-            targetk = self.target
+            spk = MX.sym('SP_k', self.c.shape[0])
+            targetk = MX.sym('Target_k', self.u.shape[0])
         else:
             spk = MX.sym('SP_k', 2*(N+1))
             targetk = MX.sym('Target_k', 2*N)
@@ -546,7 +914,11 @@ class NMPC:
         xk = MX.sym('x0', self.x.shape[0])  # first point at each interval
         x0_sym = MX.sym('x0_par', self.x.shape[0])  # first point
         u0_sym = MX.sym('u0_par', self.u.shape[0])
+        d_sym = MX.sym('d_par', self.d.shape[0])
+        p_sym = MX.sym('p_par', self.p.shape[0])
         uk_prev = u0_sym
+        xtraj = []  # state at the beginning of each interval
+        utraj = []  # input applied at each interval
 
         # Empty NLP
         self.w = []
@@ -597,21 +969,18 @@ class NMPC:
                     self.ubw += [ubx]
                     self.w0 += [xguess]
 
-                # uk as decision variable
-                uk = MX.sym('u_' + str(k + 1), self.u.shape[0])
-                self.w += [uk]
-                self.lbw += list(lbu)
-                self.ubw += list(ubu)
-                self.w0 += list(uguess)
-                self.g += [uk - uk_prev]  # delta_u
-
-                # Control horizon
-                if k >= self.M:
-                    self.lbg += list(np.zeros(self.u.shape[0]))
-                    self.ubg += list(np.zeros(self.u.shape[0]))
-                else:
+                # uk as decision variable (only where the input can move)
+                if k in self.kmove:
+                    uk = MX.sym('u_' + str(k + 1), self.u.shape[0])
+                    self.w += [uk]
+                    self.lbw += list(lbu)
+                    self.ubw += list(ubu)
+                    self.w0 += list(uguess)
+                    self.g += [uk - uk_prev]  # delta_u
                     self.lbg += list(lbdu)
                     self.ubg += list(ubdu)
+                xtraj += [xk]
+                utraj += [uk]
 
                 # Loop over collocation points
                 xk_end = self.L[0] * xk
@@ -621,9 +990,9 @@ class NMPC:
                     for j in range(0, m):
                         xc += self.Ldot[j + 1, i + 1] * xki[j]
                     if not DRTO:  # check if the setpoints and targets are trajectories
-                        fi = self.F(xki[i], uk, self.d,self.p, spk, targetk, uk_prev)
+                        fi = self.F(xki[i], uk, d_sym, p_sym, spk, targetk, uk_prev)
                     else:
-                        fi = self.F(xki[i], uk, self.d, self.p, vertcat(spk[k], spk[k+N+1]),
+                        fi = self.F(xki[i], uk, d_sym, p_sym, vertcat(spk[k], spk[k+N+1]),
                                     vertcat(targetk[k], targetk[k+N]), uk_prev)
                     self.g += [self.dt * fi[0] - xc]  # model equality contraints reformulated
                     self.lbg += [np.zeros(self.x.shape[0])]
@@ -643,29 +1012,27 @@ class NMPC:
                 self.ubg += list(np.zeros(self.x.shape[0]))
 
                 # u(k-1)
-                uk_prev = copy.deepcopy(uk)
+                uk_prev = uk
+            xtraj += [xk]
 
         elif self.disc == 'single_shooting':
             # NLP build
             xi = x0_sym
             for k in range(0, self.N):
-                uk = MX.sym('u_' + str(k + 1), self.u.shape[0])
-                self.w += [uk]
-                self.lbw += list(lbu)
-                self.ubw += list(ubu)
-                self.w0 += list(uguess)
-                self.g += [uk - uk_prev]  # delta_u
-
-                # Control horizon
-                if k >= self.M:
-                    self.lbg += list(np.zeros(self.u.shape[0]))
-                    self.ubg += list(np.zeros(self.u.shape[0]))
-                else:
+                # uk as decision variable (only where the input can move)
+                if k in self.kmove:
+                    uk = MX.sym('u_' + str(k + 1), self.u.shape[0])
+                    self.w += [uk]
+                    self.lbw += list(lbu)
+                    self.ubw += list(ubu)
+                    self.w0 += list(uguess)
+                    self.g += [uk - uk_prev]  # delta_u
                     self.lbg += list(lbdu)
                     self.ubg += list(ubdu)
+                utraj += [uk]
 
                 # Integrate till the end of the interval
-                fi = self.F(xi, uk, self.d, self.p, spk, targetk, uk_prev)
+                fi = self.F(xi, uk, d_sym, p_sym, spk, targetk, uk_prev)
                 xi += self.dt*fi[0]
                 self.J += fi[1]
 
@@ -675,163 +1042,609 @@ class NMPC:
                 self.ubg += list(ubx)
 
                 # u(k-1)
-                uk_prev = copy.deepcopy(uk)
+                uk_prev = uk
 
         # NLP 
         self.nlp = {
             'x': vertcat(*self.w),
             'f': self.J,
             'g': vertcat(*self.g),
-            'p': vertcat(x0_sym, u0_sym, self.d, self.p, spk, targetk)
+            'p': vertcat(x0_sym, u0_sym, d_sym, p_sym, spk, targetk)
         }  # nlp construction
 
+        # Optimal trajectories from the decision variables
+        if self.disc == 'collocation':
+            self.traj = Function('traj', [self.nlp['x']], [horzcat(*xtraj).T, horzcat(*utraj).T],
+                                 ['w'], ['x', 'u'])
+        else:
+            self.traj = Function('traj', [self.nlp['x']], [horzcat(*utraj).T], ['w'], ['u'])
+
         # Solver
-        self.solver = nlpsol('solver', 'ipopt', self.nlp, solver_opts)  # nlp solver construction
+        scale = variable_scale(self.w0, self.lbw, self.ubw, scaling) if scaling else None
+        self.solver = nlp_solver(self.nlp, backend, hessian, solver_opts, tmax,
+                                 scale=scale)  # nlp solver construction
+        self.w0_init = copy.deepcopy(self.w0)
+
+        # Advanced-step NMPC
+        self.advanced_step = advanced_step
+        self.pool = None  # background solver
+        self.job = None  # pending advanced step
+        if advanced_step:
+            self.build_sensitivity(linsol)
+
+    def reset(self):
+        """
+        Restores the initial guess, clears the input plan and the solver
+        statistics (new simulation)
+        """
+
+        self.discard()
+        self.w0 = copy.deepcopy(self.w0_init)
+        self.uplan = None
+        self.telemetry.reset()
+
+    def set_blocks(self, blocks=None):
+        """
+        Move blocking: number of intervals each free input is held (at most M
+        positive integers summing to N). By default the first M-1 moves are
+        held for one interval and the last one till the end of the horizon
+        """
+
+        if blocks is None:
+            nmoves = min(self.M, self.N)
+            blocks = (nmoves - 1)*[1] + [self.N - nmoves + 1]
+        else:
+            blocks = list(blocks)
+            if not blocks or any(int(b) != b or b < 1 for b in blocks):
+                raise ValueError('blocks must be a non-empty list of positive integers, got '
+                                 + str(blocks))
+            if len(blocks) > self.M:
+                raise ValueError('blocks has ' + str(len(blocks)) + ' moves, more than M = '
+                                 + str(self.M))
+            if sum(blocks) != self.N:
+                raise ValueError('blocks must sum to the horizon N = ' + str(self.N)
+                                 + ', got ' + str(sum(blocks)))
+            blocks = [int(b) for b in blocks]
+        self.blocks = blocks
+        self.nmoves = len(blocks)
+        self.kmove = list(np.cumsum([0] + blocks[:-1]))  # intervals where u can move
+        self.imove = list(np.repeat(np.arange(self.nmoves), blocks))  # move applied at each interval
 
     def calc_actions(self, x0, u0, sp, target=[], d0=[], p0=[], ksim=None):
         """
-        Performs 1 optimization step for the NMPC 
+        Performs 1 optimization step for the NMPC. If the solver fails or the
+        time budget is exceeded, the previous plan shifted by one step is applied
         """
 
         # Solver run
-        sol = self.solver(x0=vertcat(*self.w0), p=vertcat(x0, u0, d0, p0, sp, target),
-                          lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw),
-                          lbg=vertcat(*self.lbg), ubg=vertcat(*self.ubg))
+        self.discard()  # the solver is not shared with a pending advanced step
+        start = time.perf_counter()
+        self.args = dict(x0=vertcat(*self.w0), p=vertcat(x0, u0, d0, p0, sp, target),
+                         lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw),
+                         lbg=vertcat(*self.lbg), ubg=vertcat(*self.ubg))
+        sol = self.solver(**self.args)
+        tsol = time.perf_counter() - start
         flag = self.solver.stats()
+        self.telemetry.record(flag, tsol)
+        fallback = not flag['success'] or (self.tmax is not None and tsol > self.tmax)
 
-        if ksim != None:
-            if flag['return_status'] != 'Solve_Succeeded':  # checks if solver converged
-                print('Time step ' + str(ksim) + ': NMPC solver did not converge.')
-            else:
-                print('Time step ' + str(ksim) + ': NMPC optimal solution found.')
+        return self.actions(sol['x'], u0, fallback, {
+            'status': flag['return_status'],
+            'iter': flag['iter_count'],
+            'time': tsol,
+            'fallback': fallback
+        }, ksim)
+
+    def actions(self, wopt, u0, fallback, stats, ksim=None):
+        """
+        Control actions from the NLP solution (or the shifted previous plan)
+        """
+
+        step = 'Time step ' + str(ksim) if ksim != None else 'Time step'
+        if fallback:  # checks if solver converged in time
+            print(step + ': NMPC solver did not converge, applying shifted plan.')
         else:
-            if flag['return_status'] != 'Solve_Succeeded':  # checks if solver converged
-                print('Time step: NMPC solver did not converge.')
-            else:
-                print('Time step: NMPC optimal solution found.')
+            print(step + ': NMPC optimal solution found.')
 
         # Solution
-        wopt = sol['x'].full()
-        self.w0 = copy.deepcopy(wopt)  # solution as guess for the next opt step
+        if not fallback:
+            wopt = DM(wopt).full()
+            self.w0 = copy.deepcopy(wopt)  # solution as guess for the next opt step
+            traj = self.traj(w=wopt)
+            xopt = traj['x'].full() if self.disc == 'collocation' else None  # optimal state
+            uopt = traj['u'].full()  # optimal inputs
+        elif self.uplan is not None:
+            xopt = None
+            uopt = np.vstack([self.uplan[1:, :], self.uplan[-1:, :]])  # shifted plan
+        else:
+            xopt = None
+            uopt = np.tile(np.array(u0, dtype=float).reshape(1, -1), (self.N, 1))  # hold u0
+        self.uplan = uopt
 
+        # First control action
+        uin = uopt[0, :]
         if self.disc == 'collocation':
-            xopt = np.zeros((self.N + 1, self.x.shape[0]))
-            uopt = np.zeros((self.N, self.u.shape[0]))
-            for i in range(0, self.x.shape[0]):
-                xopt[:, i] = wopt[i::self.x.shape[0] + self.u.shape[0] +
-                                     self.x.shape[0] * self.m].reshape(-1)  # optimal state
-            for i in range(0, self.u.shape[0]):
-                uopt[:, i] = wopt[self.x.shape[0] + self.x.shape[0] * self.m + i::self.x.shape[0] +
-                                                                                  self.x.shape[0] * self.m +
-                                                                                  self.u.shape[0]].reshape(
-                    -1)  # optimal inputs
-
-            # First control action
-            uin = uopt[0, :]
             return {
                 'x': xopt,
                 'u': uopt,
-                'uin': uin
+                'uin': uin,
+                **stats
             }
         elif self.disc == 'single_shooting':
-            uopt = wopt
-
-            # First control action
-            uin = uopt[:self.u.shape[0]]
             return {
                 'u': uopt,
-                'u_in': uin
+                'uin': uin,
+                'u_in': uin,
+                **stats
             }
 
+    def build_sensitivity(self, linsol='qr'):
+        """
+        KKT matrices of the NLP for the advanced-step (sensitivity) update.
+        The KKT linear solver runs in the background thread, so it cannot be
+        MUMPS, which crashes when an IPOPT solver runs at the same time
+        """
+
+        if linsol == 'mumps':
+            raise ValueError('The advanced-step KKT solver cannot be MUMPS, use e.g. qr or ldl.')
+
+        w = self.nlp['x']
+        par = self.nlp['p']
+        g = self.nlp['g']
+        lam = MX.sym('lam_g', g.shape[0])
+        H, Lw = hessian(self.nlp['f'] + dot(lam, g), w)  # Hessian of the Lagrangian
+        self.kkt = Function('kkt', [w, par, lam], [H, jacobian(g, w), jacobian(Lw, par),
+                            jacobian(g, par)], ['w', 'p', 'lam_g'], ['H', 'Jg', 'Lwp', 'Gp'])
+        self.fdx = Function('f', [self.x, self.u, self.d, self.p], [self.dx])
+        self.linsol = linsol
+        self.pool = ThreadPoolExecutor(max_workers=1)  # background solver
+
+    def discard(self):
+        """
+        Waits for a pending advanced step and drops it
+        """
+
+        if getattr(self, 'job', None) is not None:
+            wait([self.job])
+            self.job = None
+
+    def close(self):
+        """
+        Shuts down the background solver of the advanced step
+        """
+
+        self.discard()
+        if getattr(self, 'pool', None) is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __del__(self):
+        self.close()
+
+    def predict(self, x0, u0, d0=[], p0=[], nsteps=4):
+        """
+        Predicts the state at the next sampling instant (RK4)
+        """
+
+        xk = DM(x0)
+        h = self.dt/nsteps
+        for i in range(0, nsteps):
+            k1 = self.fdx(xk, u0, d0, p0)
+            k2 = self.fdx(xk + h/2*k1, u0, d0, p0)
+            k3 = self.fdx(xk + h/2*k2, u0, d0, p0)
+            k4 = self.fdx(xk + h*k3, u0, d0, p0)
+            xk = xk + h/6*(k1 + 2*k2 + 2*k3 + k4)
+        return xk.full().ravel()
+
+    def prepare(self, x0, u0, sp, target=[], d0=[], p0=[]):
+        """
+        Starts solving the NMPC for the predicted state x0 in the background
+        (advanced step) and returns immediately. The solve works on its own
+        copy of the arguments and its result is only read by correct()
+        """
+
+        self.discard()  # one solve at a time
+        self.args = dict(x0=DM(vertcat(*self.w0)), p=DM(vertcat(x0, u0, d0, p0, sp, target)),
+                         lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw),
+                         lbg=vertcat(*self.lbg), ubg=vertcat(*self.ubg))
+        self.job = self.pool.submit(self.advanced_solve, dict(self.args))
+
+    def advanced_solve(self, args, tol=1e-6):
+        """
+        Solves the NLP and factorizes its KKT matrix on the active set
+        (background thread: only reads the solver and the KKT functions)
+        """
+
+        start = time.perf_counter()
+        sol = self.solver(**args)
+        tsol = time.perf_counter() - start
+        flag = self.solver.stats()
+
+        # Active set: bounds with nonzero multipliers are fixed, equalities and
+        # active inequalities are kept
+        lam_x = sol['lam_x'].full().ravel()
+        lam_g = sol['lam_g'].full().ravel()
+        lbg = args['lbg'].full().ravel()
+        ubg = args['ubg'].full().ravel()
+        free = list(np.where(np.abs(lam_x) <= tol)[0])
+        act = list(np.where((lbg == ubg) | (np.abs(lam_g) > tol))[0])
+
+        # KKT matrix and its factorization
+        H, Jg, Lwp, Gp = self.kkt(sol['x'], args['p'], sol['lam_g'])
+        A = Jg[act, free]
+        K = sparsify(blockcat([[H[free, free], A.T], [A, -1e-12*DM.eye(len(act))]]))
+        ls = Linsol('kkt', self.linsol, K.sparsity())
+        if free:  # else every variable is at a bound and the step stays put
+            ls.sfact(K)
+            ls.nfact(K)
+
+        return {
+            'w': sol['x'],
+            'par': args['p'],
+            'free': free,
+            'K': K,
+            'ls': ls,
+            'dF': vertcat(Lwp[free, :], Gp[act, :]),
+            'lbw': args['lbx'],
+            'ubw': args['ubx'],
+            'stats': flag,
+            'solve_time': tsol,
+            'time': time.perf_counter() - start
+        }
+
+    def correct(self, x0, u0, sp, target=[], d0=[], p0=[], ksim=None):
+        """
+        Waits for the advanced step and corrects its solution for the actual
+        x0 (and parameters) with one solve of the stored KKT factorization.
+        Without a pending advanced step (e.g. the first sample), the NLP is
+        solved for x0 as in calc_actions
+        """
+
+        if self.job is None:
+            return self.calc_actions(x0, u0, sp, target, d0, p0, ksim)
+        step = self.job.result()
+        self.job = None
+        flag = step['stats']
+        self.telemetry.record(flag, step['solve_time'])
+        start = time.perf_counter()
+        dp = vertcat(x0, u0, d0, p0, sp, target) - step['par']
+        w = DM(step['w'])
+        if step['free']:
+            dz = step['ls'].solve(step['K'], -mtimes(step['dF'], dp))  # sensitivity update
+            w[step['free']] = w[step['free']] + dz[:len(step['free'])]
+        w = fmin(fmax(w, step['lbw']), step['ubw'])
+        tcorr = time.perf_counter() - start
+        fallback = not flag['success'] or (self.tmax is not None and step['time'] > self.tmax)
+
+        return self.actions(w, u0, fallback, {
+            'status': flag['return_status'],
+            'iter': flag['iter_count'],
+            'time': tcorr,
+            'solve_time': step['time'],
+            'fallback': fallback
+        }, ksim)
+
+
+class MultiStageNMPC(NMPC):
+    """
+    This class creates a multi-stage (scenario-tree) robust NMPC using casadi
+    symbolic framework. The tree branches once (robust horizon of 1) into every
+    combination of the parameter multipliers in pvar, e.g. pvar=[[1, 1.05, .95],
+    [1, 1.1, .9]] gives 9 scenarios around the nominal p0. All scenarios share
+    the first move (non-anticipativity) and are simulated by a mapped Function
+    evaluated in parallel.
+    """
+
+    def __init__(self, dt, N, M, Q, W, x, u, c, d, p, dx, pvar, weights=None,
+                 xguess=None, uguess=None, lbx=None, ubx=None, lbu=None, ubu=None,
+                 lbdu=None, ubdu=None, blocks=None, parallel='thread', nthreads=None,
+                 tmax=None, backend='ipopt', hessian='exact', scaling=None, solver_opts={}):
+
+        self.dt = dt
+        self.telemetry = Telemetry()  # solver statistics
+        self.dx = dx
+        self.x = x
+        self.c = c
+        self.u = u
+        self.d = d
+        self.p = p
+        self.N = N
+        self.M = M
+        self.disc = 'single_shooting'
+        self.Q = Q
+        self.W = W
+        self.tmax = tmax  # time budget of each call (s)
+        self.uplan = None  # last valid input plan
+
+        # Move blocking
+        self.set_blocks(blocks)
+
+        # Scenarios (nominal scenario first)
+        self.scen = np.array(list(itertools.product(*pvar)), dtype=float)  # parameter multipliers
+        self.ns = self.scen.shape[0]
+        self.weights = np.ones(self.ns)/self.ns if weights is None else np.array(weights)
+        nthreads = os.cpu_count() if nthreads is None else nthreads
+
+        # Guesses
+        xguess = np.zeros(self.x.shape[0]) if xguess is None else xguess
+        uguess = np.zeros(self.u.shape[0]) if uguess is None else uguess
+        lbx = -inf * np.ones(self.x.shape[0]) if lbx is None else lbx
+        lbu = -inf * np.ones(self.u.shape[0]) if lbu is None else lbu
+        lbdu = -inf * np.ones(self.u.shape[0]) if lbdu is None else lbdu
+        ubx = +inf * np.ones(self.x.shape[0]) if ubx is None else ubx
+        ubu = +inf * np.ones(self.u.shape[0]) if ubu is None else ubu
+        ubdu = +inf * np.ones(self.u.shape[0]) if ubdu is None else ubdu
+
+        # Removing Nones inside vectors
+        if None in xguess: xguess = np.array([0 if v is None else v for v in xguess])
+        if None in uguess: uguess = np.array([0 if v is None else v for v in uguess])
+        if None in lbx: lbx = np.array([-inf if v is None else v for v in lbx])
+        if None in lbu: lbu = np.array([-inf if v is None else v for v in lbu])
+        if None in lbdu: lbdu = np.array([-inf if v is None else v for v in lbdu])
+        if None in ubx: ubx = np.array([+inf if v is None else v for v in ubx])
+        if None in ubu: ubu = np.array([+inf if v is None else v for v in ubu])
+        if None in ubdu: ubdu = np.array([+inf if v is None else v for v in ubdu])
+
+        # Quadratic cost function
+        sym = type(self.x).sym  # SX or MX, as the model
+        self.sp = sym('SP', self.c.shape[0])
+        self.uprev = sym('u_prev', self.u.shape[0])
+        J = (self.c - self.sp).T @ Q @ (self.c - self.sp) + \
+            (self.u - self.uprev).T @ W @ (self.u - self.uprev)
+        self.F = Function('F', [self.x, self.u, self.d, self.p, self.sp, self.uprev],
+                          [self.dx, J], ['x', 'u', 'd', 'p', 'sp', 'u_prev'],
+                          ['dx', 'J'])  # NMPC model function
+
+        # Single scenario: single shooting over the horizon
+        x0_s = MX.sym('x0', self.x.shape[0])
+        U_s = MX.sym('U', self.u.shape[0], self.nmoves)
+        u0_s = MX.sym('u0', self.u.shape[0])
+        d_s = MX.sym('d', self.d.shape[0])
+        p_s = MX.sym('p', self.p.shape[0])
+        sp_s = MX.sym('sp', self.c.shape[0])
+        xi = x0_s
+        uk_prev = u0_s
+        J_s = 0
+        X_s = []
+        for k in range(0, self.N):
+            uk = U_s[:, self.imove[k]]
+            fi = self.F(xi, uk, d_s, p_s, sp_s, uk_prev)
+            xi = xi + self.dt*fi[0]
+            J_s += fi[1]
+            X_s += [xi]
+            uk_prev = uk
+        self.F_scen = Function('F_scen', [x0_s, U_s, u0_s, d_s, p_s, sp_s],
+                               [J_s, horzcat(*X_s)], ['x0', 'U', 'u0', 'd', 'p', 'sp'],
+                               ['J', 'X'])  # scenario function
+        self.F_map = self.F_scen.map(self.ns, parallel, nthreads)  # all scenarios
+
+        # NLP parameters
+        x0_sym = MX.sym('x0_par', self.x.shape[0])
+        u0_sym = MX.sym('u0_par', self.u.shape[0])
+        d_sym = MX.sym('d_par', self.d.shape[0])
+        p_sym = MX.sym('p_par', self.p.shape[0])  # nominal parameters
+        sp_sym = MX.sym('SP_par', self.c.shape[0])
+
+        # Empty NLP
+        self.w = []
+        self.w0 = []
+        self.lbw = []
+        self.ubw = []
+        self.g = []
+        self.lbg = []
+        self.ubg = []
+
+        # First move (non-anticipativity)
+        u1 = MX.sym('u_1', self.u.shape[0])
+        self.w += [u1]
+        self.lbw += list(lbu)
+        self.ubw += list(ubu)
+        self.w0 += list(uguess)
+        self.g += [u1 - u0_sym]  # delta_u
+        self.lbg += list(lbdu)
+        self.ubg += list(ubdu)
+
+        # Remaining moves of each scenario
+        U = []
+        for s in range(0, self.ns):
+            uk_prev = u1
+            Us = [u1]
+            for j in range(1, self.nmoves):
+                uk = MX.sym('u_' + str(s + 1) + '_' + str(j + 1), self.u.shape[0])
+                self.w += [uk]
+                self.lbw += list(lbu)
+                self.ubw += list(ubu)
+                self.w0 += list(uguess)
+                self.g += [uk - uk_prev]  # delta_u
+                self.lbg += list(lbdu)
+                self.ubg += list(ubdu)
+                Us += [uk]
+                uk_prev = uk
+            U += Us
+
+        # Scenario predictions
+        P = mtimes(diag(p_sym), DM(self.scen.T))  # parameters of each scenario
+        Jmap, Xmap = self.F_map(x0_sym, horzcat(*U), u0_sym, d_sym, P, sp_sym)
+        self.J = mtimes(Jmap, DM(self.weights))
+
+        # Inequality constraint
+        self.g += [vec(Xmap)]
+        self.lbg += self.ns*self.N*list(lbx)
+        self.ubg += self.ns*self.N*list(ubx)
+
+        # NLP
+        self.nlp = {
+            'x': vertcat(*self.w),
+            'f': self.J,
+            'g': vertcat(*self.g),
+            'p': vertcat(x0_sym, u0_sym, d_sym, p_sym, sp_sym)
+        }  # nlp construction
+
+        # Optimal trajectories (nominal scenario) from the decision variables
+        self.traj = Function('traj', [self.nlp['x']], [horzcat(*[U[i] for i in self.imove]).T],
+                             ['w'], ['u'])
+
+        # Solver
+        scale = variable_scale(self.w0, self.lbw, self.ubw, scaling) if scaling else None
+        self.solver = nlp_solver(self.nlp, backend, hessian, solver_opts, tmax,
+                                 scale=scale)  # nlp solver construction
+        self.w0_init = copy.deepcopy(self.w0)
+
+
+class MeasurementWindow:
+    """
+    Fixed-capacity window of the last N samples (one row per sample) for the
+    MHE. Each sample is written twice in a 2N-row buffer, so appending is O(1)
+    and the window is always a contiguous view, oldest sample first
+    """
+
+    def __init__(self, N, ncol):
+        self.N = N
+        self.buffer = np.zeros((2*N, ncol))
+        self.i = 0  # position of the oldest sample
+        self.count = 0  # samples appended
+
+    def append(self, row):
+        """
+        Appends 1 sample (the first one fills the whole window)
+        """
+
+        if self.count == 0:
+            self.buffer[:, :] = row
+        else:
+            self.buffer[self.i, :] = row
+            self.buffer[self.i + self.N, :] = row
+            self.i = (self.i + 1) % self.N
+        self.count += 1
+
+    @property
+    def window(self):
+        return self.buffer[self.i:self.i + self.N, :]
+
+    @property
+    def full(self):
+        return self.count >= self.N
+
 
 class MHE:
     """
-      This class creates an MHE using casadi symbolic framework
+      This class creates an MHE using casadi symbolic framework. With rti=True
+      it takes a single Gauss-Newton SQP step per sample (real-time iteration),
+      which cannot be combined with scaling or log_theta (the single step on
+      the scaled NLP diverges). RTI trades accuracy for time: with multiple
+      shooting the closed-loop C_A error (RMSE) grows from 0.39 to 0.57
+      compared with the converged MHE
       """
 
     def __init__(self, dt, N, x, u, d, p, dx, Q, W=None, R=None, xguess=None,
                  uguess=None, dguess=None, pguess=None, lbx=None, ubx=None,
                  lbu=None, ubu=None, lbd=None, lbp=None, ubd=None, ubp=None,
-                 pol='legendre', m=3, solver_opts={}):
+                 disc='collocation', pol='legendre', m=3, nsteps=4, arrival=False, P0=None,
+                 Qw=None, theta_blocks=None, startup=False, rti=False, backend='ipopt',
+                 hessian='exact', scaling=None, log_theta=(), solver_opts={}):
 
+        settings = {k: v for k, v in locals().items() if k != 'self'}  # for the start-up MHEs
         self.dt = dt
+        self.telemetry = Telemetry()  # solver statistics
         self.dx = dx
         self.x = x
         self.u = u
         self.d = d
         self.p = p
         self.N = N
+        self.disc = disc
         self.m = m
         self.pol = pol
+        self.nsteps = nsteps
+        self.est_theta = R is not None  # parameter estimation?
+        self.est_u = W is not None  # input estimation?
+        self.arrival = arrival  # arrival cost (free initial state)?
 
         # State estimation
         self.Q = Q
-        self.ymeas = MX.sym('y_meas', self.x.shape[0])
-        ymeask = MX.sym('y_meas_k', N, self.ymeas.shape[0])
-        xguess = self.x.shape[0]*[0] if xguess is None else xguess
-        lbx = list(-inf*np.ones(self.x.shape[0])) if lbx is None else lbx
-        ubx = list(+inf*np.ones(self.x.shape[0])) if ubx is None else ubx
+        sym = type(self.x).sym  # SX or MX, as the model
+        self.ymeas = sym('y_meas', self.x.shape[0])
+        ymeask = MX.sym('y_meas_k', self.ymeas.shape[0], N)  # one column per sample
+        xguess = self.x.shape[0]*[0] if xguess is None else list(xguess)
+        lbx = list(-inf*np.ones(self.x.shape[0])) if lbx is None else list(lbx)
+        ubx = list(+inf*np.ones(self.x.shape[0])) if ubx is None else list(ubx)
 
         # Parameter estimation?
-        if R.all:
-            self.R = R # parameter matrix
-            self.theta = vertcat(self.d, self.p) # disturbances + uncertain parameters
-            self.thetaref = MX.sym('theta_ref', self.theta.shape[0]) # reference
-            thetarefk = MX.sym('theta_ref_k', N, self.thetaref.shape[0])  # reference vector
-            dguess = self.d.shape[0]*[0] if dguess is None else dguess
-            pguess = self.p.shape[0]*[0] if pguess is None else pguess
+        self.theta = vertcat(self.d, self.p)  # disturbances + uncertain parameters
+        if self.est_theta:
+            self.R = R  # parameter matrix
+            self.thetaref = sym('theta_ref', self.theta.shape[0])  # reference
+            dguess = self.d.shape[0]*[0] if dguess is None else list(dguess)
+            pguess = self.p.shape[0]*[0] if pguess is None else list(pguess)
             thetaguess = dguess + pguess
-            lbd = list(-inf*np.ones(self.d.shape[0])) if lbd is None else lbd
-            lbp = list(-inf*np.ones(self.p.shape[0])) if lbp is None else lbp
-            ubd = list(+inf*np.ones(self.d.shape[0])) if ubd is None else ubd
-            ubp = list(+inf*np.ones(self.p.shape[0])) if ubp is None else ubp
+            lbd = list(-inf*np.ones(self.d.shape[0])) if lbd is None else list(lbd)
+            lbp = list(-inf*np.ones(self.p.shape[0])) if lbp is None else list(lbp)
+            ubd = list(+inf*np.ones(self.d.shape[0])) if ubd is None else list(ubd)
+            ubp = list(+inf*np.ones(self.p.shape[0])) if ubp is None else list(ubp)
         else:
-            self.R = np.zeros((self.theta.shape[0], self.theta.shape[0]))
-            self.theta = MX.sym('theta', 0)
-            self.thetaref = MX.sym('theta_ref', 0)
+            self.R = np.zeros((0, 0))
+            self.thetaref = sym('theta_ref', 0)
             thetaguess = []
             lbd = []
             ubd = []
             lbp = []
             ubp = []
+        thetarefk = MX.sym('theta_ref_k', self.thetaref.shape[0], N)  # reference vector
         lbtheta = lbd + lbp
         ubtheta = ubd + ubp
+        self.set_theta_blocks(theta_blocks)
 
         # Input estimation?
-        if W:
+        if self.est_u:
             self.W = W
-            self.unom = MX.sym('u_nom', self.u.shape[0])
-            unomk = MX.sym('u_nom_k', N, self.unom.shape[0])
-            uguess = self.u.shape[0]*[0] if uguess is None else uguess
+            self.unom = sym('u_nom', self.u.shape[0])
+            uguess = self.u.shape[0]*[0] if uguess is None else list(uguess)
             lbu = list(-inf*np.ones(self.u.shape[0]) if lbu is None else lbu)
             ubu = list(+inf*np.ones(self.u.shape[0]) if ubu is None else ubu)
         else:
-            self.W = np.zeros((self.u.shape[0], self.u.shape[0]))
-            self.unom = MX.sym('u_nom', 0)
+            self.W = np.zeros((0, 0))
+            self.unom = sym('u_nom', 0)
             uguess = []
             lbu = []
             ubu = []
+        unomk = MX.sym('u_nom_k', self.unom.shape[0], N)
 
         # Removing Nones inside vectors
-        if None in xguess: xguess = np.array([0 if v is None else v for v in xguess])
-        if None in uguess: uguess = np.array([0 if v is None else v for v in uguess])
-        if None in thetaguess: thetaguess = np.array([0 if v is None else v for v in thetaguess])
-        if None in lbx: lbx = np.array([-inf if v is None else v for v in lbx])
-        if None in lbu: lbu = np.array([-inf if v is None else v for v in lbu])
-        if None in ubx: ubx = np.array([+inf if v is None else v for v in ubx])
-        if None in ubu: ubu = np.array([+inf if v is None else v for v in ubu])
+        if None in xguess: xguess = [0 if v is None else v for v in xguess]
+        if None in uguess: uguess = [0 if v is None else v for v in uguess]
+        if None in thetaguess: thetaguess = [0 if v is None else v for v in thetaguess]
+        if None in lbx: lbx = [-inf if v is None else v for v in lbx]
+        if None in lbu: lbu = [-inf if v is None else v for v in lbu]
+        if None in ubx: ubx = [+inf if v is None else v for v in ubx]
+        if None in ubu: ubu = [+inf if v is None else v for v in ubu]
+        if None in lbtheta: lbtheta = [-inf if v is None else v for v in lbtheta]
+        if None in ubtheta: ubtheta = [+inf if v is None else v for v in ubtheta]
 
         # Quadratic cost function
-        J = (self.x - self.ymeas).T @ self.Q @(self.x - self.ymeas) + \
-            (self.theta - self.thetaref).T @ self.R @ (self.theta - self.thetaref)
+        J = (self.x - self.ymeas).T @ self.Q @ (self.x - self.ymeas)
+        r = [matrix_sqrt(self.Q) @ (self.x - self.ymeas)]  # residuals (J = r'r)
+        if self.est_theta:
+            J += (self.theta - self.thetaref).T @ self.R @ (self.theta - self.thetaref)
+            r += [matrix_sqrt(self.R) @ (self.theta - self.thetaref)]
+        if self.est_u:
+            J += (self.u - self.unom).T @ self.W @ (self.u - self.unom)
+            r += [matrix_sqrt(self.W) @ (self.u - self.unom)]
 
         # MHE model function
-        self.F = Function('F_MHE', [self.x, self.u, self.d, self.p, self.ymeas, self.thetaref],
-                          [self.dx, J], ['x', 'u', 'd', 'p', 'y_meas', 'theta_ref'], ['dx', 'J'])
+        self.F = Function('F_MHE', [self.x, self.u, self.d, self.p, self.ymeas, self.thetaref,
+                                    self.unom], [self.dx, J, vertcat(*r)],
+                          ['x', 'u', 'd', 'p', 'y_meas', 'theta_ref', 'u_nom'], ['dx', 'J', 'r'])
 
         # "Lift" initial conditions
         xk = MX.sym('x0', self.x.shape[0])  # first state at each interval
         x0_sym = MX.sym('x0_par', self.x.shape[0])  # initial state
+        u_sym = MX.sym('u_par', self.u.shape[0])  # known inputs and parameters
+        d_sym = MX.sym('d_par', self.d.shape[0])
+        p_sym = MX.sym('p_par', self.p.shape[0])
+        xtraj = []
+        utraj = []
+        thetatraj = []
+        thetaki = self.theta.shape[0]*[None]  # current value of each parameter
 
         # Empty NLP
         self.w = []
@@ -842,21 +1655,28 @@ class MHE:
         self.lbg = []
         self.ubg = []
         self.J = 0
+        self.r = []  # weighted residuals
+        Jq = 0  # quadratic terms outside the residuals
 
         # NLP
         self.w += [xk]
         self.w0 += xguess
         self.lbw += lbx
-        self.ubw = ubx
-        self.g += [xk - x0_sym]
-        self.lbg += self.dx.shape[0]*[0]
-        self.ubg += self.dx.shape[0]*[0]
+        self.ubw += ubx
+        if self.arrival:
+            S = MX.sym('S', self.x.shape[0], self.x.shape[0])  # inverse of the covariance
+            Jq = (xk - x0_sym).T @ S @ (xk - x0_sym)
+            self.J += Jq
+        else:
+            self.g += [xk - x0_sym]
+            self.lbg += self.dx.shape[0]*[0]
+            self.ubg += self.dx.shape[0]*[0]
 
         # Polynomials
         self.tau = np.array([0] + collocation_points(self.m, self.pol))
         self.L = np.zeros((self.m + 1, 1))
         self.Ldot = np.zeros((self.m + 1, self.m + 1))
-        self.Lint = self.L
+        self.Lint = np.zeros((self.m + 1, 1))
         for i in range(0, self.m + 1):
             coeff = 1
             for j in range(0, self.m + 1):
@@ -873,32 +1693,53 @@ class MHE:
         for k in range(0, self.N):
             # State at collocation points
             xki = []
-            for i in range(0, self.m):
+            for i in range(0, self.m if self.disc == 'collocation' else 0):
                 xki.append(MX.sym('x_' + str(k + 1) + '_' + str(i + 1), self.x.shape[0]))
                 self.w += [xki[i]]
                 self.lbw += lbx
                 self.ubw += ubx
                 self.w0 += xguess
 
-            # xk and thetak as decision variables
-            thetak = MX.sym('theta_k' + str(k + 1), self.thetaref.shape[0])
-            self.w += [thetak]
-            self.lbw += lbtheta
-            self.ubw +=  ubtheta
-            self.w0 += thetaguess
+            # uk and thetak as decision variables (or parameters)
+            if self.est_u:
+                uk = MX.sym('u_' + str(k + 1), self.u.shape[0])
+                self.w += [uk]
+                self.lbw += lbu
+                self.ubw += ubu
+                self.w0 += uguess
+            else:
+                uk = u_sym
+            if self.est_theta:
+                for i in range(0, self.theta.shape[0]):
+                    if k % self.theta_blocks[i] == 0:  # new value of the component
+                        thetaki[i] = MX.sym('theta_' + str(k + 1) + '_' + str(i + 1))
+                        self.w += [thetaki[i]]
+                        self.lbw += [lbtheta[i]]
+                        self.ubw += [ubtheta[i]]
+                        self.w0 += [thetaguess[i]]
+                thetak = vertcat(*thetaki)
+                dk = thetak[:self.d.shape[0]]
+                pk = thetak[self.d.shape[0]:]
+            else:
+                dk = d_sym
+                pk = p_sym
+            xtraj += [xk]
+            utraj += [uk]
+            thetatraj += [vertcat(dk, pk)]
 
             # Loop over collocation points
             xk_end = self.L[0]*xk
-            for i in range(0, self.m):
+            for i in range(0, len(xki)):
                 xk_end += self.L[i + 1]*xki[i]  # add contribution to the end state
                 xc = self.Ldot[0, i + 1]*xk  # expression for the state derivative at the collocation point
                 for j in range(0, m):
                     xc += self.Ldot[j + 1, i + 1]*xki[j]
-                    fi = self.F(xki[i], self.u, self.d, self.p, ymeask[k, :], thetarefk[k, :])
+                fi = self.F(xki[i], uk, dk, pk, ymeask[:, k], thetarefk[:, k], unomk[:, k])
                 self.g += [self.dt*fi[0] - xc]  # model equality constraints reformulated
                 self.lbg += self.x.shape[0]*[0]
                 self.ubg += self.x.shape[0]*[0]
                 self.J += self.dt*fi[1]*self.Lint[i + 1]  # add contribution to obj. quadrature function
+                self.r += [np.sqrt(self.dt*self.Lint[i + 1, 0])*fi[2]]
 
             # New NLP variable for state at end of interval
             xk = MX.sym('x_' + str(k + 2), self.x.shape[0])
@@ -908,20 +1749,36 @@ class MHE:
             self.w0 += xguess
 
             # No shooting-gap constraint
-            self.g += [xk - xk_end]
-            self.lbg += self.x.shape[0] * [0]
-            self.ubg += self.x.shape[0] * [0]
+            if self.disc == 'collocation':
+                self.g += [xk - xk_end]
+                self.lbg += self.x.shape[0] * [0]
+                self.ubg += self.x.shape[0] * [0]
+        xtraj += [xk]
+
+        # Multiple shooting: RK4 over all the intervals at once
+        if self.disc == 'multiple_shooting':
+            Fmap = self.build_rk4().expand().map(self.N)
+            Xk = horzcat(*xtraj)
+            Fk = Fmap(Xk[:, :-1], horzcat(*utraj), horzcat(*thetatraj)[:self.d.shape[0], :],
+                      horzcat(*thetatraj)[self.d.shape[0]:, :], ymeask, thetarefk, unomk)
+            self.g += [vec(Xk[:, 1:] - Fk[0])]  # shooting-gap constraints
+            self.lbg += self.N*self.x.shape[0]*[0]
+            self.ubg += self.N*self.x.shape[0]*[0]
+            self.J += sum2(Fk[1])
+            self.r += [vec(Fk[2])]
 
         # NLP construction
         # NLP parameters
-        if self.R and self.W:
-            par = vertcat(x0_sym, ymeask, unomk, thetarefk)
-        elif self.R and not self.W:
-            par = vertcat(x0_sym, self.u, ymeask, thetarefk)
-        elif not self.R and self.W:
-            par = vertcat(x0_sym, self.d, self.p, ymeask, unomk)
+        if self.est_theta and self.est_u:
+            par = vertcat(x0_sym, vec(ymeask), vec(unomk), vec(thetarefk))
+        elif self.est_theta and not self.est_u:
+            par = vertcat(x0_sym, u_sym, vec(ymeask), vec(thetarefk))
+        elif not self.est_theta and self.est_u:
+            par = vertcat(x0_sym, d_sym, p_sym, vec(ymeask), vec(unomk))
         else:
-            par = vertcat(x0_sym, self.u, self.d, self.p, ymeask)
+            par = vertcat(x0_sym, u_sym, d_sym, p_sym, vec(ymeask))
+        if self.arrival:
+            par = vertcat(par, vec(S))
 
         # Dict
         self.nlp = {
@@ -931,38 +1788,249 @@ class MHE:
             'p': par
         }
 
+        # Optimal trajectories from the decision variables
+        self.traj = Function('traj', [self.nlp['x'], par],
+                             [horzcat(*xtraj).T, horzcat(*utraj).T, horzcat(*thetatraj).T],
+                             ['w', 'p'], ['x', 'u', 'theta'])
+
+        # Real-time iteration: 1 Gauss-Newton SQP step per sample from the shifted estimate
+        self.rti = rti
+        if self.rti:
+            if scaling or len(log_theta) > 0:
+                raise ValueError('The real-time iteration cannot be combined with scaling or '
+                                 'log_theta.')
+            backend = backend if BACKENDS[backend]['plugin'] == 'sqpmethod' else 'sqp_osqp'
+            hessian = 'gauss-newton'
+            solver_opts = dict(solver_opts, max_iter=1, max_iter_ls=0)
+            self.build_shift()
+
         # Solver
-        self.solver = nlpsol('solver', 'ipopt', self.nlp, solver_opts)  # nlp solver construction
+        self.residual = (vertcat(*self.r), Jq)
+        scale = variable_scale(self.w0, self.lbw, self.ubw, scaling) if scaling else None
+        self.solver = nlp_solver(self.nlp, backend, hessian, solver_opts,
+                                 residual=self.residual, scale=scale,
+                                 log_index=self.theta_index(log_theta))  # nlp solver construction
+        self.w0_init = copy.deepcopy(self.w0)
+
+        # Arrival cost
+        if self.arrival:
+            self.build_arrival(P0, Qw)
+
+        # Start-up solvers (horizons 1 ... N-1)
+        self.startup = startup
+        self.startup_mhe = {}
+        if startup:
+            for n in range(1, self.N):
+                self.startup_mhe[n] = MHE(**dict(settings, N=n, startup=False))
+                self.startup_mhe[n].telemetry = self.telemetry
+
+    def reset(self):
+        """
+        Restores the initial guess and the initial arrival cost, and clears the
+        solver statistics (new simulation)
+        """
+
+        self.w0 = copy.deepcopy(self.w0_init)
+        self.telemetry.reset()
+        if self.arrival:
+            self.P = copy.deepcopy(self.P0)
+            self.x0bar = None
+        for mhe in self.startup_mhe.values():
+            mhe.reset()
 
-    def update(self, x0, ymeas, uf=[], df=[], pf=[], unom=[], thetaref=[], ksim=None):
+    def build_shift(self):
         """
-        Performs 1 estimation step for the MHE
+        Index map that shifts the decision variables one interval back (each
+        variable takes the value of the same variable of the next interval,
+        the last ones are kept)
         """
 
+        offsets = np.cumsum([0] + [v.numel() for v in self.w])
+        blocks = {}
+        for i, v in enumerate(self.w):
+            name = v.name().split('_')
+            k = 1 if name[0] == 'x0' else int(name[1])
+            role = 'x' if name[0] == 'x0' else '_'.join([name[0]] + name[2:])
+            blocks[(role, k)] = i
+        self.shift_index = np.arange(offsets[-1])
+        for (role, k), i in blocks.items():
+            j = blocks.get((role, k + 1))
+            if j is not None and self.w[j].numel() == self.w[i].numel():
+                self.shift_index[offsets[i]:offsets[i + 1]] = np.arange(offsets[j], offsets[j + 1])
+
+    def theta_index(self, components):
+        """
+        Positions in the decision variables of the given components of theta
+        (e.g. for a log parameterization)
+        """
+
+        offsets = np.cumsum([0] + [v.numel() for v in self.w])
+        index = []
+        for i, v in enumerate(self.w):
+            name = v.name().split('_')
+            if name[0] == 'theta' and int(name[2]) - 1 in components:
+                index.append(offsets[i])
+        return index
+
+    def build_rk4(self):
+        """
+        Builds the RK4 integrator of one interval with the cost as quadrature
+        (multiple shooting)
+        """
+
+        h = self.dt/self.nsteps
+        args = [self.ymeas, self.thetaref, self.unom]
+        xk = self.x
+        qk = 0
+        rk = []  # residuals of the quadrature (qf = rf'rf)
+        for i in range(0, self.nsteps):
+            k1 = self.F(xk, self.u, self.d, self.p, *args)
+            k2 = self.F(xk + h/2*k1[0], self.u, self.d, self.p, *args)
+            k3 = self.F(xk + h/2*k2[0], self.u, self.d, self.p, *args)
+            k4 = self.F(xk + h*k3[0], self.u, self.d, self.p, *args)
+            xk = xk + h/6*(k1[0] + 2*k2[0] + 2*k3[0] + k4[0])
+            qk = qk + h/6*(k1[1] + 2*k2[1] + 2*k3[1] + k4[1])
+            rk += [np.sqrt(h/6)*k1[2], np.sqrt(h/3)*k2[2], np.sqrt(h/3)*k3[2],
+                   np.sqrt(h/6)*k4[2]]
+        return Function('F_RK4', [self.x, self.u, self.d, self.p] + args, [xk, qk, vertcat(*rk)],
+                        ['x', 'u', 'd', 'p', 'y_meas', 'theta_ref', 'u_nom'], ['xf', 'qf', 'rf'])
+
+    def set_theta_blocks(self, theta_blocks=None):
+        """
+        Sets how each component of theta is estimated over the window: 'free'
+        (one value per interval), 'constant' (one value) or an integer n
+        (piecewise constant in blocks of n intervals)
+        """
+
+        theta_blocks = self.theta.shape[0]*['free'] if theta_blocks is None else theta_blocks
+        self.theta_blocks = []
+        for b in theta_blocks:
+            if b == 'free':
+                self.theta_blocks.append(1)
+            elif b == 'constant':
+                self.theta_blocks.append(self.N)
+            else:
+                self.theta_blocks.append(int(b))
+
+    def build_arrival(self, P0=None, Qw=None, nsteps=4):
+        """
+        Builds the one-step model (RK4) and its jacobian used to propagate the
+        arrival cost (smoothed EKF update)
+        """
+
+        # Covariances (default: one sample of measurement information)
+        self.P0 = np.linalg.pinv(self.dt*np.asarray(self.Q)) if P0 is None else np.asarray(P0)
+        self.Qw = self.P0 if Qw is None else np.asarray(Qw)  # process noise covariance
+        self.P = copy.deepcopy(self.P0)
+        self.x0bar = None
+
+        # One-step model
+        fdx = Function('f', [self.x, self.u, self.d, self.p], [self.dx])
+        h = self.dt/nsteps
+        xk = self.x
+        for i in range(0, nsteps):
+            k1 = fdx(xk, self.u, self.d, self.p)
+            k2 = fdx(xk + h/2*k1, self.u, self.d, self.p)
+            k3 = fdx(xk + h/2*k2, self.u, self.d, self.p)
+            k4 = fdx(xk + h*k3, self.u, self.d, self.p)
+            xk = xk + h/6*(k1 + 2*k2 + 2*k3 + k4)
+        self.phi = Function('phi', [self.x, self.u, self.d, self.p], [xk, jacobian(xk, self.x)],
+                            ['x', 'u', 'd', 'p'], ['xf', 'F'])
+
+    def update_arrival(self, xopt, u0, d0, p0):
+        """
+        Shifts the arrival cost one sample (smoothed EKF update): the
+        covariance takes the information of the measurement leaving the window
+        and is propagated, and the prior becomes the first MHE state xopt
+        propagated one sample (both linearized at xopt)
+        """
+
+        xf, F = self.phi(xopt, u0, d0, p0)
+        F = F.full()
+
+        # Measurement update (information form, y = x)
+        I0 = self.dt*np.asarray(self.Q)
+        P = np.linalg.inv(np.linalg.inv(self.P) + I0)
+
+        # Prediction
+        self.P = F @ P @ F.T + self.Qw
+        self.x0bar = xf.full().ravel()
+
+    def update_startup(self, n, x0, ymeas, uf=[], df=[], pf=[], unom=[], thetaref=[], ksim=None):
+        """
+        Performs 1 estimation step with the MHE of horizon n, on the last n
+        samples (fewer than N measurements available)
+        """
+
+        def last(v):
+            v = v.window if isinstance(v, MeasurementWindow) else np.asarray(v, dtype=float)
+            return v[-n:] if v.size else v
+
+        mhe = self.startup_mhe[n]
+        if self.arrival:  # same prior until the window is full
+            if self.x0bar is None:
+                self.x0bar = np.array(x0, dtype=float).ravel()
+            mhe.x0bar = self.x0bar
+            mhe.P = self.P
+        return mhe.update(x0, last(ymeas), uf, df, pf, last(unom), last(thetaref), ksim,
+                          shift=False)
+
+    def update(self, x0, ymeas, uf=[], df=[], pf=[], unom=[], thetaref=[], ksim=None,
+               shift=True):
+        """
+        Performs 1 estimation step for the MHE (ymeas, unom and thetaref hold
+        one row per sample of the window, as arrays or MeasurementWindow
+        objects). With arrival cost, x0 only sets the initial prior and the
+        prior is shifted after the solve if shift is True (window full)
+        """
+
+        # Start-up: shorter horizon until the window is full
+        n = ymeas.count if isinstance(ymeas, MeasurementWindow) else len(ymeas)
+        if self.startup and n < self.N:
+            return self.update_startup(n, x0, ymeas, uf, df, pf, unom, thetaref, ksim)
+
+        # Windows (sample by sample)
+        ymeas = ymeas.window if isinstance(ymeas, MeasurementWindow) else ymeas
+        unom = unom.window if isinstance(unom, MeasurementWindow) else unom
+        thetaref = thetaref.window if isinstance(thetaref, MeasurementWindow) else thetaref
+        ymeas = np.asarray(ymeas, dtype=float).reshape(-1)
+        unom = np.asarray(unom, dtype=float).reshape(-1)
+        thetaref = np.asarray(thetaref, dtype=float).reshape(-1)
+
         # Solver parameters
-        if self.R and self.W:
+        if self.est_theta and self.est_u:
             par = vertcat(x0, ymeas, unom, thetaref)
-        elif self.R and not self.W:
+        elif self.est_theta and not self.est_u:
             par = vertcat(x0, uf, ymeas, thetaref)
-        elif not self.R and self.W:
+        elif not self.est_theta and self.est_u:
             par = vertcat(x0, df, pf, ymeas, unom)
         else:
             par = vertcat(x0, uf, df, pf, ymeas)
+        if self.arrival:
+            if self.x0bar is None:
+                self.x0bar = np.array(x0, dtype=float).ravel()  # copy (x0 may be a view)
+            par[:self.x.shape[0]] = self.x0bar
+            par = vertcat(par, vec(DM(np.linalg.inv(self.P))))
 
         # Solver run
-        sol = self.solver(x0=vertcat(*self.w0), p=par,
-                          lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw),
-                          lbg=vertcat(*self.lbg), ubg=vertcat(*self.ubg))
+        self.args = dict(x0=vertcat(*self.w0), p=par,
+                         lbx=vertcat(*self.lbw), ubx=vertcat(*self.ubw),
+                         lbg=vertcat(*self.lbg), ubg=vertcat(*self.ubg))
+        tic = time.perf_counter()
+        sol = self.solver(**self.args)
         flag = self.solver.stats()
+        self.telemetry.record(flag, time.perf_counter() - tic)
+        if self.rti:  # the single iteration is the intended stop
+            flag['success'] = flag['success'] or flag['return_status'] == 'Maximum_Iterations_Exceeded'
 
         # Check convergence
         if ksim != None:
-            if flag['return_status'] != 'Solve_Succeeded':
+            if not flag['success']:
                 print('Time step ' + str(ksim) + ': MHE solver did not converge.')
             else:
                 print('Time step ' + str(ksim) + ': MHE optimal solution found.')
         else:
-            if flag['return_status'] != 'Solve_Succeeded':
+            if not flag['success']:
                 print('Time step: MHE solver did not converge.')
             else:
                 print('Time step: MHE optimal solution found.')
@@ -970,49 +2038,122 @@ class MHE:
         # Solution
         wopt = sol['x'].full()
 
-        # Solution as guess for the next opt step
-        self.w0 = copy.deepcopy(wopt)
+        # Solution as guess for the next opt step (shifted for the RTI)
+        self.w0 = wopt[self.shift_index] if self.rti and shift else copy.deepcopy(wopt)
 
-        # Optimal states
-        xopt = np.zeros((self.N + 1, self.x.shape[0]))
-        for i in range(0, self.x.shape[0]):
-            xopt[:, i] = wopt[i::
-                              self.x.shape[0] +
-                              self.u.shape[0] +
-                              self.theta.shape[0] +
-                              self.x.shape[0]*self.m].reshape(-1)
-        # Optimal inputs
-        uopt = np.zeros((self.N, self.u.shape[0])) if self.W else None
-        for i in range(0, self.unom.shape[0]):
-            uopt[:, i] = wopt[self.x.shape[0] +
-                              self.x.shape[0]*self.m +
-                              i::
-                              self.x.shape[0] +
-                              self.x.shape[0]*self.m +
-                              self.u.shape[0]].reshape(-1)
-
-        # Optimal parameters
-        thetaopt = np.zeros((self.N, self.theta.shape[0])) if self.R else None
-        for i in range(0, self.thetaref.shape[0]):
-            thetaopt[:, i] = wopt[self.x.shape[0] +
-                                  self.x.shape[0]*self.m +
-                                  self.u.shape[0] +
-                                  i::
-                                  self.x.shape[0] +
-                                  self.x.shape[0]*self.m +
-                                  self.u.shape[0] +
-                                  self.theta.shape[0]].reshape(-1)
-
-            # Estimates
-            xhat = xopt[-1, :]
-            uhat = uopt[-1, :]
-            thetahat = thetaopt[-1, :]
+        # Optimal states, inputs and parameters
+        traj = self.traj(w=wopt, p=par)
+        xopt = traj['x'].full()
+        uopt = traj['u'].full() if self.est_u else None
+        thetaopt = traj['theta'].full() if self.est_theta else None
 
-            return {
-                'x': xopt,
-                'u': uopt,
-                'theta': thetaopt,
-                'x_hat': xhat,
-                'u_hat': uhat,
-                'theta_hat': thetahat
-            }
+        # Estimates
+        xhat = xopt[-1, :]
+        uhat = uopt[-1, :] if self.est_u else None
+        thetahat = thetaopt[-1, :] if self.est_theta else None
+
+        # Arrival cost for the next window
+        if self.arrival and shift:
+            u0 = uopt[0, :] if self.est_u else uf
+            d0 = thetaopt[0, :self.d.shape[0]] if self.est_theta else df
+            p0 = thetaopt[0, self.d.shape[0]:] if self.est_theta else pf
+            self.update_arrival(xopt[0, :], u0, d0, p0)
+
+        return {
+            'x': xopt,
+            'u': uopt,
+            'theta': thetaopt,
+            'x_hat': xhat,
+            'u_hat': uhat,
+            'theta_hat': thetahat
+        }
+
+
+class SolverSelector:
+    """
+    This class records NLP instances solved by the NMPC/MHE/LSE/ODEModel
+    objects and benchmarks the solver backends on them to pick the fastest
+    one that converges reliably
+    """
+
+    def __init__(self, backends=None, hessians=('exact', 'limited-memory'), opts={}):
+        self.backends = available_backends() if backends is None else backends
+        self.hessians = hessians
+        self.opts = opts  # common nlpsol options (e.g. printing)
+        self.instances = []  # (nlp, solver arguments)
+        self.results = []
+
+    def record(self, obj):
+        """
+        Records the last problem solved by obj
+        """
+
+        args = {k: DM(v) for k, v in obj.args.items()}
+        self.instances.append((obj.nlp, args, getattr(obj, 'residual', None)))
+
+    def benchmark(self, nrep=1, tmax=None, verbose=True):
+        """
+        Solves every recorded instance nrep times with each backend/Hessian
+        pair. A solve counts as successful if it converges within tmax (s),
+        checked on the wall clock since only IPOPT stops itself at tmax, and
+        a pair is dropped once one solve takes longer. CasADi errors (e.g. a
+        plugin that cannot load or handle the NLP) count as failed solves and
+        their messages are kept in the 'errors' of the results
+        """
+
+        self.results = []
+        for backend in self.backends:
+            plugin = BACKENDS[backend]['plugin']
+            hessians = self.hessians if plugin in ('ipopt', 'sqpmethod') else ('exact',)
+            for hessian in hessians:
+                solvers = {}  # one solver per distinct NLP
+                nsucc = 0
+                tsol = []
+                errors = []
+                for nlp, args, residual in self.instances:
+                    if tsol and tmax is not None and max(tsol) > tmax:
+                        tsol += nrep*[inf]  # too slow
+                        continue
+                    n0 = len(tsol)
+                    try:
+                        if id(nlp) not in solvers:
+                            solvers[id(nlp)] = nlp_solver(nlp, backend, hessian, self.opts, tmax,
+                                                          residual)
+                        solver = solvers[id(nlp)]
+                        for i in range(0, nrep):
+                            start = time.perf_counter()
+                            solver(**args)
+                            tsol += [time.perf_counter() - start]
+                            nsucc += solver.stats()['success'] and (tmax is None or tsol[-1] <= tmax)
+                    except RuntimeError as e:  # raised by casadi
+                        errors.append(str(e))
+                        tsol += (n0 + nrep - len(tsol))*[inf]
+                self.results.append({
+                    'backend': backend,
+                    'hessian': hessian,
+                    'success_rate': nsucc/max(nrep*len(self.instances), 1),
+                    'mean_time': np.mean(tsol) if tsol else inf,
+                    'max_time': np.max(tsol) if tsol else inf,
+                    'errors': errors
+                })
+                if verbose:
+                    r = self.results[-1]
+                    print('%-12s %-15s success %5.1f%%  mean %.4f s  max %.4f s' %
+                          (backend, hessian, 100*r['success_rate'], r['mean_time'], r['max_time']))
+                    for e in errors[:1]:
+                        print('    ' + e.strip().splitlines()[-1])
+        return self.results
+
+    def select(self, min_rate=1.0, nrep=1, tmax=None):
+        """
+        Returns (backend, hessian) of the fastest backend with a success rate
+        of at least min_rate
+        """
+
+        if not self.results:
+            self.benchmark(nrep=nrep, tmax=tmax)
+        ok = [r for r in self.results if r['success_rate'] >= min_rate]
+        if not ok:
+            raise RuntimeError('No backend converged on ' + str(100*min_rate) + '% of the instances.')
+        best = min(ok, key=lambda r: r['mean_time'])
+        return best['backend'], best['hessian']
@@ -0,0 +1,252 @@
+# Closed-loop simulation engine: pluggable plant, estimator and controller
+# stages, preallocated structured results and per-stage wall times
+
+import math
+import sys
+import time
+import numpy as np
+from CasadiTools import MeasurementWindow
+from ResultStore import ResultReader, ResultWriter
+
+
+class ODEPlant:
+    """
+    Plant stage: simulates an ODEModel one sample with noisy measurements of
+    the states and of the disturbances in measured_d
+    """
+
+    def __init__(self, model, x0, disturbance, par, noise=0.001, measured_d=(), seed=None):
+        self.model = model
+        self.xf = np.array(x0, dtype=float)
+        self.disturbance = disturbance  # function of the fraction of the simulation
+        self.par = par
+        self.noise = noise  # relative noise
+        self.measured_d = list(measured_d)
+        self.rng = np.random.default_rng(seed)
+        nx = self.xf.shape[0]
+        nu = model.u.shape[0]
+        nd = model.d.shape[0]
+        npar = model.p.shape[0]
+        self.fields = [('y', nx), ('u', nu), ('d', nd), ('p', npar)]
+
+    def step(self, data):
+        """
+        Performs 1 plant step with the input data['u']
+        """
+
+        dist = self.disturbance(data['k']/data['niter'])
+        sim = self.model.simulate_step(xf=self.xf, uf=data['u'], df=dist, pf=self.par)
+        self.xf = sim['x'].ravel()
+        nx = self.xf.shape[0]
+        d = np.asarray(sim['d'], dtype=float)
+        return {
+            'y': self.xf,
+            'u': sim['u'],
+            'd': d,
+            'p': sim['p'],
+            'y_meas': self.xf*(1 + self.noise*self.rng.normal(0, 1, nx)),
+            'd_meas': d[self.measured_d]*(1 + self.noise*self.rng.normal(0, 1, len(self.measured_d)))
+        }
+
+
+class MHEEstimator:
+    """
+    Estimator stage: MHE on measurement windows. The parameter reference is
+    the last estimate with the measured disturbances replaced by their
+    measurements
+    """
+
+    def __init__(self, mhe, theta0, measured_d=()):
+        self.mhe = mhe
+        nx = mhe.x.shape[0]
+        self.thetahat = np.array(theta0, dtype=float)
+        self.measured_d = list(measured_d)
+        self.ywin = MeasurementWindow(mhe.N, nx)  # last N measurements
+        self.thetarefwin = MeasurementWindow(mhe.N, self.thetahat.shape[0])
+        self.xwin = MeasurementWindow(mhe.N, nx)  # initial states of the next windows
+        self.fields = [('x_est', nx), ('theta_est', self.thetahat.shape[0])]
+
+    def step(self, data):
+        """
+        Performs 1 estimation step with data['y_meas'] and data['d_meas']
+        """
+
+        thetaref = self.thetahat.copy()
+        thetaref[self.measured_d] = data['d_meas']
+        self.ywin.append(data['y_meas'])
+        self.thetarefwin.append(thetaref)
+        if self.xwin.count == 0:
+            self.xwin.append(data['y_meas'])
+        est = self.mhe.update(x0=self.xwin.window[0], uf=data['u'], ymeas=self.ywin,
+                              thetaref=self.thetarefwin, shift=self.ywin.full)
+        xhat = np.array(est['x_hat'], dtype=float).ravel()
+        self.thetahat = np.array(est['theta_hat'], dtype=float).ravel()
+        self.xwin.append(xhat)
+        return {
+            'x_est': xhat,
+            'theta_est': self.thetahat
+        }
+
+
+class NMPCController:
+    """
+    Controller stage: NMPC from the estimated states, disturbances and
+    parameters (theta = (d, p)). With an advanced-step NMPC, the NLP of the
+    next sample is solved in the background for the predicted state while the
+    plant and the estimator run, and only corrected for the new estimate
+    """
+
+    def __init__(self, nmpc, sp):
+        self.nmpc = nmpc
+        self.sp = sp
+        self.nd = nmpc.d.shape[0]
+        self.advanced_step = getattr(nmpc, 'advanced_step', False)
+        self.fields = []
+
+    def step(self, data):
+        """
+        Computes the input of the next sample
+        """
+
+        theta = data['theta_est']
+        d0 = list(theta[:self.nd])
+        p0 = list(theta[self.nd:])
+        if self.advanced_step:
+            ctrl = self.nmpc.correct(ksim=data['k'] + 1, x0=data['x_est'], u0=data['u'],
+                                     sp=self.sp, d0=d0, p0=p0)
+            xnext = self.nmpc.predict(data['x_est'], ctrl['uin'], d0, p0)
+            self.nmpc.prepare(xnext, ctrl['uin'], self.sp, d0=d0, p0=p0)
+        else:
+            ctrl = self.nmpc.calc_actions(ksim=data['k'] + 1, x0=data['x_est'], u0=data['u'],
+                                          sp=self.sp, d0=d0, p0=p0)
+        return {
+            'u': list(ctrl['uin'])
+        }
+
+
+class ClosedLoop:
+    """
+    This class runs a closed loop of plant, estimator and controller stages.
+    Each stage has a step(data) method returning a dict merged into the data
+    of the sample and a fields list [(name, size)] of the values to store.
+    With realtime=True, samples are paced on a monotonic clock (period dt in
+    time_unit seconds, divided by time_scale) and an input computed after
+    the next sampling instant is discarded (the last valid one is held).
+    After an overrun the loop resumes at the next clock tick (the ticks
+    skipped are counted)
+    """
+
+    def __init__(self, dt, plant, estimator, controller, u0, progress=1.0, realtime=False,
+                 time_scale=1.0, time_unit=3600):
+        self.dt = dt
+        self.stages = [('plant', plant), ('estimator', estimator), ('controller', controller)]
+        self.u0 = list(u0)
+        self.progress = progress  # s between progress reports (None: quiet)
+        self.realtime = realtime
+        self.period = dt*time_unit/time_scale  # wall-clock sampling period (s)
+
+    def dtype(self):
+        """
+        Structured dtype of the results (one record per sample)
+        """
+
+        fields = [('time', float)]
+        for name, stage in self.stages:
+            fields += [(f, float, (n,)) for f, n in stage.fields]
+        fields += [('t_' + name, float) for name, stage in self.stages]
+        fields += [('t_total', float)]
+        if self.realtime:
+            fields += [('lateness', float), ('latency', float), ('miss', bool), ('skipped', int)]
+        return np.dtype(fields)
+
+    def report(self, k, niter, start):
+        """
+        Prints the progress on one line
+        """
+
+        elapsed = time.perf_counter() - start
+        eta = elapsed/k*(niter - k) if k > 0 else 0
+        sys.stdout.write('\rSimulation %d/%d (%3.0f%%), elapsed %.0f s, remaining %.0f s'
+                         % (k, niter, 100*k/niter, elapsed, eta))
+        sys.stdout.flush()
+
+    def run(self, tsim, store=None):
+        """
+        Simulates tsim and returns the structured result array. With store (a
+        ResultStore.ResultWriter, or a directory), records are streamed to disk
+        one chunk at a time and a lazy ResultStore.ResultReader is returned
+        """
+
+        niter = math.ceil(tsim/self.dt)
+        if store is None:
+            res = np.zeros(niter, dtype=self.dtype())
+        else:
+            store = ResultWriter(store, self.dtype()) if isinstance(store, str) else store
+            res = store.buffer
+        u = self.u0
+        start = time.perf_counter()
+        last = -math.inf  # last progress report
+        t0 = time.monotonic() + (self.period if self.realtime else 0)  # first sampling instant
+        tick = 0  # clock tick of the sample
+        for k in range(0, niter):
+            i = k if store is None else store.i  # row of the sample
+            res['time'][i] = tsim*k/max(niter - 1, 1)
+            if self.realtime:
+                skipped = max(math.floor((time.monotonic() - t0)/self.period) - tick, 0)
+                tick += skipped
+                tk = t0 + tick*self.period  # scheduled sampling instant
+                time.sleep(max(tk - time.monotonic(), 0))
+                res['lateness'][i] = time.monotonic() - tk
+                res['skipped'][i] = skipped
+                tick += 1
+            data = {'k': k, 'niter': niter, 'u': u}
+            tstep = time.perf_counter()
+            for name, stage in self.stages:
+                tic = time.perf_counter()
+                out = stage.step(data)
+                res['t_' + name][i] = time.perf_counter() - tic
+                for f, n in stage.fields:
+                    res[f][i] = out[f]
+                data.update(out)
+            res['t_total'][i] = time.perf_counter() - tstep
+            if self.realtime:
+                res['latency'][i] = time.monotonic() - tk
+                res['miss'][i] = res['latency'][i] > self.period
+                u = u if res['miss'][i] else data['u']  # late input discarded
+            else:
+                u = data['u']
+            if store is not None:
+                store.advance()
+            if self.progress is not None and time.perf_counter() - last >= self.progress:
+                last = time.perf_counter()
+                self.report(k + 1, niter, start)
+        if self.progress is not None:
+            self.report(niter, niter, start)
+            sys.stdout.write('\n')
+        if store is not None:
+            store.close()
+            return ResultReader(store.path)
+        return res
+
+
+def timing_report(res, period, q=(50, 90, 99)):
+    """
+    Latency percentiles, jitter (lateness of the sampling instants) and
+    deadline-miss rate of a real-time run
+    """
+
+    latency = np.asarray(res['latency'])
+    lateness = np.asarray(res['lateness'])
+    out = {
+        'period': period,
+        'latency_mean': np.mean(latency),
+        'latency_max': np.max(latency),
+        'jitter_mean': np.mean(lateness),
+        'jitter_std': np.std(lateness),
+        'jitter_max': np.max(lateness),
+        'miss_rate': np.mean(np.asarray(res['miss'])),
+        'ticks_skipped': int(np.sum(np.asarray(res['skipped'])))
+    }
+    for p in q:
+        out['latency_p' + str(p)] = np.percentile(latency, p)
+    return out
@@ -0,0 +1,208 @@
+# Pipelined closed loop of main.py: plant, MHE and NMPC run as separate
+# workers (processes or threads) that exchange samples over queues
+
+import math
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+import Scenario
+from ClosedLoop import ODEPlant, MHEEstimator, NMPCController
+
+
+def plant_worker(q_u, q_y, q_res, niter, seed=None, par_plant=Scenario.par_plant,
+                 disturbance=Scenario.disturbance):
+    """
+    Plant stand-in: applies the input of each sample and sends the measurements
+    """
+
+    k = None
+    try:
+        plant = ODEPlant(Scenario.build_process(), Scenario.xf0, disturbance, par_plant,
+                         measured_d=Scenario.measured_d, seed=seed)
+        q_res.put(('ready', None, plant.fields))
+
+        for k in range(0, niter):
+            uf = q_u.get()  # blocks until the input of sample k is available
+            if uf is None:
+                break
+            out = plant.step({'k': k, 'niter': niter, 'u': uf})
+            tmeas = time.perf_counter()
+            q_y.put({'k': k, 'u': uf, 'y_meas': out['y_meas'], 'd_meas': out['d_meas'],
+                     't_meas': tmeas})
+            q_res.put(('plant', k, dict({f: out[f] for f, n in plant.fields}, t_meas=tmeas)))
+        q_y.put(None)
+    except Exception:
+        q_res.put(('error', k, traceback.format_exc()))
+
+
+def estimator_worker(q_y, q_x, q_res, mhe_kwargs={}):
+    """
+    MHE: estimates the states and parameters of each measured sample
+    """
+
+    k = None
+    try:
+        estimator = MHEEstimator(Scenario.build_mhe(**mhe_kwargs),
+                                 Scenario.dist0 + Scenario.par_model,
+                                 measured_d=Scenario.measured_d)
+        q_res.put(('ready', None, estimator.fields))
+
+        while True:
+            meas = q_y.get()
+            if meas is None:
+                break
+            k = meas['k']
+            tic = time.perf_counter()
+            out = estimator.step(meas)
+            t_mhe = time.perf_counter() - tic
+            q_x.put(dict(out, k=k, t_meas=meas['t_meas']))
+            q_res.put(('mhe', k, dict(out, t_mhe=t_mhe)))
+        q_x.put(None)
+    except Exception:
+        q_res.put(('error', k, traceback.format_exc()))
+
+
+def controller_worker(q_x, q_u, q_res, pipelined=True, nmpc_kwargs={}):
+    """
+    NMPC: computes the input of the next sample from each estimate. When
+    pipelined, the estimate is first predicted over the input already queued
+    to the plant and the result is applied one sample later
+    """
+
+    k = None
+    try:
+        controller = NMPCController(Scenario.build_nmpc(**nmpc_kwargs), Scenario.sp)
+        model = Scenario.build_process()  # one-step predictor
+        uf = list(Scenario.uf0)  # last input sent to the plant
+        q_res.put(('ready', None, controller.fields))
+
+        while True:
+            est = q_x.get()
+            if est is None:
+                break
+            k = est['k']
+            tic = time.perf_counter()
+            data = dict(est, u=uf)
+            if pipelined:
+                theta = est['theta_est']
+                data['x_est'] = model.simulate_step(xf=est['x_est'], uf=uf,
+                                                    df=list(theta[:controller.nd]),
+                                                    pf=list(theta[controller.nd:]))['x']
+            out = controller.step(data)
+            uf = out['u']
+            q_u.put(uf)
+            tout = time.perf_counter()
+            q_res.put(('nmpc', k, dict({f: out[f] for f, n in controller.fields},
+                                       t_nmpc=tout - tic, latency=tout - est['t_meas'])))
+    except Exception:
+        q_res.put(('error', k, traceback.format_exc()))
+
+
+def get_result(q_res, jobs, timeout=None, poll=1.0):
+    """
+    Next record of the workers. Raises RuntimeError with the traceback of a
+    failed worker, when a worker process dies or all workers have stopped, or
+    when no record arrives within timeout (s)
+    """
+
+    start = time.monotonic()
+    while True:
+        try:
+            stage, k, out = q_res.get(timeout=poll)
+        except queue.Empty:
+            for job in jobs:
+                if getattr(job, 'exitcode', None) not in (None, 0):  # processes only
+                    raise RuntimeError('%s worker died (exit code %d)' % (job.name, job.exitcode))
+            if not any(job.is_alive() for job in jobs):
+                raise RuntimeError('Workers stopped before sending all the results')
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise RuntimeError('No result from the workers in %g s' % timeout)
+            continue
+        if stage == 'error':
+            raise RuntimeError('Worker failed%s:\n%s' % ('' if k is None else ' at sample %d' % k,
+                                                          out))
+        return stage, k, out
+
+
+def stop_workers(jobs, queues):
+    """
+    Unblocks the workers waiting on the queues and terminates the worker
+    processes still running
+    """
+
+    for q in queues:
+        q.put(None)
+    for job in jobs:
+        job.join(timeout=1)
+        if job.is_alive() and hasattr(job, 'terminate'):
+            job.terminate()
+
+
+def run_pipeline(tsim=2, seed=None, pipelined=True, workers='process',
+                 par_plant=Scenario.par_plant, mhe_kwargs={}, nmpc_kwargs={}, timeout=None):
+    """
+    Runs the closed loop of main.py with the plant, MHE and NMPC as concurrent
+    workers. With pipelined=True, the input computed from sample k is applied
+    at sample k+2, so the MHE of sample k+1 overlaps the NMPC of sample k;
+    otherwise the loop is sequential (input applied at k+1). Latency is the
+    time from the measurement to the input computed from it. A worker error is
+    raised as RuntimeError (timeout: longest wait for a worker result, s)
+    """
+
+    niter = math.ceil(tsim/Scenario.dt)
+    if workers == 'process':
+        Queue, Worker = multiprocessing.Queue, multiprocessing.Process
+    else:
+        Queue, Worker = queue.Queue, threading.Thread
+    q_u, q_y, q_x, q_res = Queue(), Queue(), Queue(), Queue()
+    jobs = [
+        Worker(target=plant_worker, args=(q_u, q_y, q_res, niter, seed, par_plant),
+               name='plant', daemon=True),
+        Worker(target=estimator_worker, args=(q_y, q_x, q_res, mhe_kwargs),
+               name='estimator', daemon=True),
+        Worker(target=controller_worker, args=(q_x, q_u, q_res, pipelined, nmpc_kwargs),
+               name='controller', daemon=True)
+    ]
+    for job in jobs:
+        job.start()
+    try:
+        fields = []  # values stored by the stages (name, size)
+        for job in jobs:
+            fields += get_result(q_res, jobs, timeout)[2]  # all workers built
+
+        # Inputs applied before the first NMPC result
+        start = time.perf_counter()
+        for i in range(0, 2 if pipelined else 1):
+            q_u.put(list(Scenario.uf0))
+
+        res = {f: np.zeros([niter, n]) for f, n in fields}
+        for f in ('t_meas', 't_mhe', 't_nmpc', 'latency'):
+            res[f] = np.zeros(niter)
+        for i in range(0, 3*niter):
+            stage, k, out = get_result(q_res, jobs, timeout)
+            for key, val in out.items():
+                res[key][k] = val
+    except BaseException:
+        stop_workers(jobs, (q_u, q_y, q_x))
+        raise
+
+    res['wall_time'] = time.perf_counter() - start
+    for job in jobs:
+        job.join()
+    res['time'] = np.linspace(0, tsim, niter)
+    res['period'] = np.diff(res['t_meas'])
+    return res
+
+
+if __name__ == '__main__':
+    for pipelined in (False, True):
+        res = run_pipeline(tsim=1, pipelined=pipelined)
+        print('pipelined' if pipelined else 'sequential')
+        print('  wall time %.2f s, mean sample period %.3f s' % (res['wall_time'],
+                                                                   np.mean(res['period'])))
+        print('  latency mean %.3f s, max %.3f s' % (np.mean(res['latency']),
+                                                      np.max(res['latency'])))
+        print('  IAE Cb %.4f, IAE T %.4f' % tuple(Scenario.performance(res).values())[:2])
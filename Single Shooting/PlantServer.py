@@ -0,0 +1,295 @@
+# Local plant server: the plant of main.py served over TCP or a Unix socket
+# (asyncio, one JSON message per line) and an async MHE + NMPC client loop,
+# to measure end-to-end latency and throughput with many reactors
+
+import asyncio
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import Scenario
+from ClosedLoop import ODEPlant, MHEEstimator, NMPCController
+
+
+def encode(msg):
+    """
+    One message as a line of JSON (numpy arrays as lists)
+    """
+
+    return (json.dumps(msg, default=lambda v: v.tolist() if hasattr(v, 'tolist') else float(v))
+            + '\n').encode()
+
+
+class PlantServer:
+    """
+    This class serves reactors simulated with one ODEModel. Requests are
+    {'op': ..., 'id': reactor, ...}:
+    - reset: new reactor (x0, par, seed, niter of the disturbance profile)
+    - actuate: applies u over 1 sample (integrated in a worker thread, so
+      other clients are not blocked; one at a time, since the reactors share
+      the integrator)
+    - measure: last measurements (and the true values, for the benchmarks)
+    Each reply echoes the request 'seq' (or carries 'error')
+    """
+
+    def __init__(self, process=None, disturbance=Scenario.disturbance, measured_d=(1,)):
+        self.process = Scenario.build_process() if process is None else process
+        self.disturbance = disturbance
+        self.measured_d = list(measured_d)
+        self.executor = ThreadPoolExecutor(max_workers=1)  # plant integration
+        self.reactors = {}
+        self.nrequests = 0
+        self.server = None
+
+    def reset(self, msg):
+        plant = ODEPlant(self.process, msg.get('x0', Scenario.xf0), self.disturbance,
+                         msg.get('par', Scenario.par_plant), measured_d=self.measured_d,
+                         seed=msg.get('seed'))
+        nx = plant.xf.shape[0]
+        self.reactors[msg['id']] = {
+            'plant': plant,
+            'k': 0,
+            'niter': msg.get('niter', 1),
+            'out': {'y': plant.xf, 'y_meas': plant.xf*(1 + plant.noise*plant.rng.normal(0, 1, nx))}
+        }
+        return {}
+
+    def actuate(self, msg):
+        reactor = self.reactors[msg['id']]
+        data = {'k': reactor['k'], 'niter': reactor['niter'], 'u': msg['u']}
+        reactor['out'] = reactor['plant'].step(data)
+        reactor['k'] += 1
+        return {'k': reactor['k']}
+
+    def measure(self, msg):
+        reactor = self.reactors[msg['id']]
+        return dict(reactor['out'], k=reactor['k'])
+
+    async def handle(self, msg):
+        """
+        Reply to 1 request
+        """
+
+        self.nrequests += 1
+        try:
+            if msg['op'] not in ('reset', 'actuate', 'measure'):
+                raise ValueError('unknown op ' + str(msg['op']))
+            if msg['op'] == 'actuate':  # plant integration off the event loop
+                loop = asyncio.get_running_loop()
+                reply = await loop.run_in_executor(self.executor, self.actuate, msg)
+            else:
+                reply = getattr(self, msg['op'])(msg)
+        except KeyError as e:
+            reply = {'error': 'missing ' + str(e)}
+        except Exception as e:
+            reply = {'error': str(e)}
+        reply['seq'] = msg.get('seq')
+        return reply
+
+    async def serve_client(self, reader, writer):
+        """
+        Serves one connection until the client closes it
+        """
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(encode(await self.handle(json.loads(line))))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """
+        Starts listening on a Unix socket (path) or TCP (port 0: any free
+        port). Returns the address to give to PlantClient
+        """
+
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.serve_client, path=path)
+            return {'path': path}
+        self.server = await asyncio.start_server(self.serve_client, host=host, port=port)
+        return {'host': host, 'port': self.server.sockets[0].getsockname()[1]}
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown()
+
+
+class PlantClient:
+    """
+    This class keeps 1 connection to a PlantServer, reused by every request.
+    Requests are serialised on the connection, so reactors can share a
+    client or each have their own
+    """
+
+    def __init__(self, host='127.0.0.1', port=None, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+        self.seq = 0
+        self.rtt = []  # round-trip time of each request
+
+    async def connect(self):
+        if self.path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        return self
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def call(self, op, **kwargs):
+        """
+        Sends 1 request and waits for its reply
+        """
+
+        async with self.lock:
+            if self.writer is None:
+                await self.connect()
+            self.seq += 1
+            tic = time.perf_counter()
+            self.writer.write(encode(dict(kwargs, op=op, seq=self.seq)))
+            await self.writer.drain()
+            line = await self.reader.readline()
+            self.rtt.append(time.perf_counter() - tic)
+        if not line:
+            raise ConnectionError('plant server closed the connection')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise RuntimeError('plant server: ' + reply['error'])
+        return reply
+
+
+async def reactor_loop(client, rid, niter, estimator=None, controller=None, u0=Scenario.uf0,
+                       seed=None, par_plant=Scenario.par_plant, executor=None):
+    """
+    Closed loop of one remote reactor: actuate, measure, estimate, control.
+    The MHE and NMPC run in the executor so the other reactors keep talking
+    to the server meanwhile. Without an estimator and a controller the input
+    is held (I/O only). Latency is the time from the measurement reply to
+    the next input
+    """
+
+    loop = asyncio.get_running_loop()
+    await client.call('reset', id=rid, seed=seed, par=list(par_plant), niter=niter)
+    nx = len(Scenario.xf0)
+    res = {
+        'y': np.zeros([niter, nx]),
+        'u': np.zeros([niter, len(u0)]),
+        'x_est': np.zeros([niter, nx]),
+        't_mhe': np.zeros(niter),
+        't_nmpc': np.zeros(niter),
+        'latency': np.zeros(niter)
+    }
+    u = list(u0)
+    for k in range(0, niter):
+        await client.call('actuate', id=rid, u=u)
+        data = {'k': k, 'niter': niter, 'u': u}
+        meas = await client.call('measure', id=rid)
+        tmeas = time.perf_counter()
+        data.update(y_meas=np.array(meas['y_meas']), d_meas=np.array(meas['d_meas']))
+        res['y'][k] = meas['y']
+        res['u'][k] = u
+        if estimator is not None:
+            tic = time.perf_counter()
+            data.update(await loop.run_in_executor(executor, estimator.step, data))
+            res['t_mhe'][k] = time.perf_counter() - tic
+            res['x_est'][k] = data['x_est']
+        if controller is not None:
+            tic = time.perf_counter()
+            data.update(await loop.run_in_executor(executor, controller.step, data))
+            res['t_nmpc'][k] = time.perf_counter() - tic
+            u = data['u']
+        res['latency'][k] = time.perf_counter() - tmeas
+    return res
+
+
+async def run_reactors(n, tsim=2, address=None, shared=False, closed_loop=True, seed=0,
+                       mhe_kwargs={}, nmpc_kwargs={}, nthreads=None):
+    """
+    Runs n reactors concurrently against the plant server at address (a
+    PlantServer is started in this event loop when None). With shared=True
+    all reactors use one connection, otherwise one each. Returns the results
+    of each reactor, the wall time, the throughput (samples/s) and the
+    round-trip times
+    """
+
+    niter = math.ceil(tsim/Scenario.dt)
+    server = None
+    if address is None:
+        server = PlantServer()
+        address = await server.start()
+    stages = []
+    for i in range(0, n):  # solvers built before the clock starts
+        if closed_loop:
+            estimator = MHEEstimator(Scenario.build_mhe(**mhe_kwargs),
+                                     Scenario.dist0 + Scenario.par_model, measured_d=[1])
+            controller = NMPCController(Scenario.build_nmpc(**nmpc_kwargs), Scenario.sp)
+            stages.append((estimator, controller))
+        else:
+            stages.append((None, None))
+    clients = [PlantClient(**address) for i in range(0, 1 if shared else n)]
+    for client in clients:
+        await client.connect()
+    seeds = np.random.SeedSequence(seed).generate_state(n)
+    with ThreadPoolExecutor(max_workers=nthreads or n) as executor:
+        start = time.perf_counter()
+        results = await asyncio.gather(*[
+            reactor_loop(clients[i % len(clients)], i, niter, stages[i][0], stages[i][1],
+                         seed=int(seeds[i]), executor=executor) for i in range(0, n)])
+        wall = time.perf_counter() - start
+    for client in clients:
+        await client.close()
+    if server is not None:
+        await server.stop()
+    return {
+        'reactors': results,
+        'wall_time': wall,
+        'throughput': n*niter/wall,
+        'rtt': np.concatenate([client.rtt for client in clients])
+    }
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import os
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'plant.sock')
+    for n, closed_loop in [(1, False), (100, False), (1, True), (4, True)]:
+        for transport in ('tcp', 'unix'):
+            async def bench():
+                server = PlantServer()
+                address = await server.start(path=path if transport == 'unix' else None)
+                with contextlib.redirect_stdout(io.StringIO()):  # solver step messages
+                    out = await run_reactors(n, tsim=0.1 if closed_loop else 0.5, address=address,
+                                             closed_loop=closed_loop,
+                                             mhe_kwargs={'N': 5})
+                await server.stop()
+                return out
+            out = asyncio.run(bench())
+            latency = np.concatenate([r['latency'] for r in out['reactors']])
+            print('%3d reactors, %-11s %4s: %7.1f samples/s, rtt p50 %.3f ms p99 %.3f ms, '
+                  'latency p50 %.1f ms' % (n, 'closed loop' if closed_loop else 'I/O only',
+                                           transport, out['throughput'],
+                                           1e3*np.percentile(out['rtt'], 50),
+                                           1e3*np.percentile(out['rtt'], 99),
+                                           1e3*np.percentile(latency, 50)))
@@ -0,0 +1,146 @@
+# Chunked on-disk storage of closed-loop results: records are buffered in a
+# fixed-size chunk and written as .npy shards (memory-mappable) or compressed
+# .npz shards (one member per field), then read back lazily
+
+import glob
+import json
+import os
+import numpy as np
+
+
+class ResultWriter:
+    """
+    This class streams structured records to shards of chunk rows in the
+    directory path. The closed loop writes straight into buffer[i] and calls
+    advance(); memory is one chunk whatever the length of the run
+    """
+
+    def __init__(self, path, dtype, chunk=10000, compress=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.chunk = chunk
+        self.compress = compress
+        self.buffer = np.zeros(chunk, dtype=self.dtype)
+        self.i = 0  # rows in the buffer
+        self.nrows = 0  # rows written
+        self.nshards = 0
+        os.makedirs(path, exist_ok=True)
+        for f in glob.glob(os.path.join(path, 'shard_*')):  # previous results
+            os.remove(f)
+
+    def append(self, record):
+        """
+        Appends 1 record (dict of field values)
+        """
+
+        for key, v in record.items():
+            self.buffer[key][self.i] = v
+        self.advance()
+
+    def advance(self):
+        """
+        Commits the current buffer row (writes the chunk when full)
+        """
+
+        self.i += 1
+        if self.i == self.chunk:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows as one shard
+        """
+
+        if self.i == 0:
+            return
+        name = os.path.join(self.path, 'shard_%06d' % self.nshards)
+        rows = self.buffer[:self.i]
+        if self.compress:
+            np.savez_compressed(name + '.npz', **{f: rows[f] for f in self.dtype.names})
+        else:
+            np.save(name + '.npy', rows)
+        self.nrows += self.i
+        self.nshards += 1
+        self.i = 0
+
+    def close(self):
+        """
+        Writes the last rows and the metadata
+        """
+
+        self.flush()
+        meta = {'nrows': self.nrows, 'chunk': self.chunk, 'compress': self.compress,
+                'dtype': np.lib.format.dtype_to_descr(self.dtype)}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+class ResultReader:
+    """
+    This class reads the results written by ResultWriter lazily: .npy shards
+    are memory mapped, .npz members are only decompressed when requested.
+    res[name] returns a whole field, column() a slice or every step-th row
+    (e.g. for plotting) without loading the rest
+    """
+
+    def __init__(self, path, aliases={}):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.nrows = meta['nrows']
+        self.chunk = meta['chunk']
+        self.compress = meta['compress']
+        descr = meta['dtype']
+        descr = [tuple(d) if isinstance(d, list) else d for d in descr] if isinstance(descr, list) \
+            else descr
+        self.dtype = np.lib.format.descr_to_dtype(descr)
+        self.aliases = aliases  # other names of the fields
+        ext = '.npz' if self.compress else '.npy'
+        self.shards = sorted(glob.glob(os.path.join(path, 'shard_*' + ext)))
+
+    def __len__(self):
+        return self.nrows
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def keys(self):
+        return list(self.dtype.names) + list(self.aliases.keys())
+
+    def shard(self, i, name=None):
+        """
+        Shard i (memory-mapped structured array, or one field if name)
+        """
+
+        if self.compress:
+            with np.load(self.shards[i]) as data:
+                return data[name] if name is not None else \
+                    np.rec.fromarrays([data[f] for f in self.dtype.names], dtype=self.dtype)
+        rows = np.load(self.shards[i], mmap_mode='r')
+        return rows[name] if name is not None else rows
+
+    def chunks(self, name=None):
+        """
+        Iterates over the shards (for streaming analysis)
+        """
+
+        for i in range(0, len(self.shards)):
+            yield self.shard(i, name)
+
+    def column(self, name, start=0, stop=None, step=1):
+        """
+        Rows start:stop:step of one field, reading only the shards involved
+        """
+
+        name = self.aliases.get(name, name)
+        stop = self.nrows if stop is None else min(stop, self.nrows)
+        out = []
+        for i in range(start//self.chunk, (stop - 1)//self.chunk + 1 if stop > start else 0):
+            first = i*self.chunk
+            lo = max(start, first)
+            lo += (start - lo) % step  # keep the global stride
+            hi = min(stop, first + self.chunk)
+            if lo < hi:
+                out.append(np.array(self.shard(i, name)[lo - first:hi - first:step]))
+        shape = self.dtype[name].shape
+        return np.concatenate(out) if out else np.zeros((0,) + shape)
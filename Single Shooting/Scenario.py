@@ -0,0 +1,179 @@
+# Closed-loop scenario of main.py for the Van de Vusse CSTR: plant, MHE and
+# NMPC builders, disturbance profile and performance indices
+
+from VdVModel import vdv_model
+from CasadiTools import *
+from ClosedLoop import *
+import math
+
+# Model (SX)
+model = vdv_model(nstates=4)
+dt, x, y, u, d, p, c, dx = (model[key] for key in ('dt', 'x', 'y', 'u', 'd', 'p', 'c', 'dx'))
+
+# Solver opts
+opts = {
+    'warn_initial_bounds': False, 'print_time': False,
+    'ipopt': {'print_level': 0}
+    }
+
+# Initial guesses
+Caguess = 1.7949
+Cbguess = 1.0787
+Tguess = 144.2363
+fguess = 100
+Tkguess = 150
+Qkguess = -4000
+Cainguess = 5
+Tinguess = 130
+k01guess = 1.287e12
+cpguess = 2
+xguess = [Caguess, Cbguess, Tguess, Tkguess]
+uguess = [fguess, Qkguess]
+dguess = [Cainguess, Tinguess]
+pguess = [k01guess, cpguess]
+
+# Bounds
+lbCa = 0.1
+ubCa = 5
+lbCb = 0.1
+ubCb = 2
+lbT = 30
+ubT = 200
+lbTk = 30
+ubTk = 200
+lbf = 10
+ubf = 400
+lbQk = -8500
+ubQk = 0
+lbCain = 0.1
+ubCain = 6
+lbTin = 30
+ubTin = 200
+lbk01 = .5*k01guess
+ubk01 = 1.5*k01guess
+lbcp = .5*cpguess
+ubcp = 1.5*cpguess
+lbx = [lbCa, lbCb, lbT, lbTk]
+ubx = [ubCa, ubCb, ubT, ubTk]
+lbu = [lbf, lbQk]
+ubu = [ubf, ubQk]
+lbd = [lbCain, lbTin]
+ubd = [ubCain, ubTin]
+lbp = [lbk01, lbcp]
+ubp = [ubk01, ubcp]
+lbdu = [-50, -50]
+ubdu = [50, 50]
+
+# Initial conditions, plant/model parameters and setpoint
+xf0 = [3.08275401, 0.52532486, 122.27127671, 77.75680223]
+uf0 = [120.04167236, -4000]
+dist0 = [4, 130]
+par_model = [1.287e12, 3.01]
+par_plant = [1.287e12*.95, 3.01*0.8]
+sp = [0.5, 120]
+ic = [1, 2]  # controlled variables (Cb, T) in the state vector
+measured_d = [1]  # measured disturbances (Tin) in the disturbance vector
+
+
+def build_process(intg='idas'):
+    """
+    Builds the plant
+    """
+
+    process = ODEModel(dt=dt, x=x, y=y, u=u, dx=dx, d=d, p=p)  # process object
+    process.get_equations(intg=intg)
+    return process
+
+
+def build_mhe(N=40, Q=None, R=None, **kwargs):
+    """
+    Builds the MHE (states, disturbances and parameters)
+    """
+
+    Q = np.diag([1e1, 1e1, 1e2, 1e2])*1e-4 if Q is None else Q
+    R = np.diag([3e-2, 5e-3, 8e-1, 5e-3]) if R is None else R
+    return MHE(dt=dt, N=N, Q=Q, R=R, x=x, u=u, d=d, p=p, dx=dx, xguess=xguess,
+               uguess=uguess, dguess=dguess, pguess=pguess, lbx=lbx, ubx=ubx,
+               lbu=lbu, ubu=ubu, lbd=lbd, ubd=ubd, lbp=lbp, ubp=ubp,
+               solver_opts=opts, **kwargs)
+
+
+def build_nmpc(N=40, M=10, Q=None, W=None, disc='single_shooting', **kwargs):
+    """
+    Builds the NMPC
+    """
+
+    Q = np.diag([1, 1e-3]) if Q is None else Q
+    W = np.diag([1e-5, 1e-6]) if W is None else W
+    return NMPC(dt=dt, N=N, M=M, Q=Q, W=W, x=x, u=u, c=c, d=d, p=p, dx=dx,
+                xguess=xguess, uguess=uguess, lbx=lbx, ubx=ubx, lbu=lbu, ubu=ubu,
+                lbdu=lbdu, ubdu=ubdu, disc=disc, solver_opts=opts, **kwargs)
+
+
+def disturbance(n):
+    """
+    Disturbance profile (n is the fraction of the simulation)
+    """
+
+    if n > 1/4 and n < 2/4:
+        return [5.1, 130]
+    elif n >= 2/4:
+        return [5.1, 130*1.1]
+    else:
+        return [4, 130]
+
+
+def run_closed_loop(process, mhe, nmpc, tsim=2, seed=None, par_plant=par_plant,
+                    disturbance=disturbance, progress=None, store=None, realtime=False,
+                    time_scale=1.0):
+    """
+    Simulates the closed loop plant + MHE + NMPC of main.py. With store (a
+    directory), the results are streamed to disk and read back lazily. With
+    realtime, the samples are paced on the wall clock (9 s / time_scale)
+    """
+
+    plant = ODEPlant(process, xf0, disturbance, par_plant, measured_d=measured_d, seed=seed)
+    estimator = MHEEstimator(mhe, dist0 + par_model, measured_d=measured_d)
+    controller = NMPCController(nmpc, sp)
+    loop = ClosedLoop(dt, plant, estimator, controller, uf0, progress=progress,
+                      realtime=realtime, time_scale=time_scale)
+    res = loop.run(tsim, store=store)
+    if store is not None:
+        res.aliases = {'t_mhe': 't_estimator', 't_nmpc': 't_controller', 'cpu_time': 't_total'}
+        return res
+    out = {
+        'time': res['time'],
+        'y': res['y'],
+        'u': res['u'],
+        'd': res['d'],
+        'p': res['p'],
+        'x_est': res['x_est'],
+        'theta_est': res['theta_est'],
+        't_plant': res['t_plant'],
+        't_mhe': res['t_estimator'],
+        't_nmpc': res['t_controller'],
+        'cpu_time': res['t_total']
+    }
+    if realtime:
+        out.update(lateness=res['lateness'], latency=res['latency'], miss=res['miss'],
+                   skipped=res['skipped'])
+    return out
+
+
+def performance(res):
+    """
+    Performance indices of a closed-loop run
+    """
+
+    iae = np.sum(np.abs(res['y'][:, ic] - np.array(sp)), axis=0)*dt
+    du = np.sum(np.abs(np.diff(res['u'], axis=0)), axis=0)
+    return {
+        'IAE_Cb': iae[0],
+        'IAE_T': iae[1],
+        'du_f': du[0],
+        'du_Qk': du[1],
+        'mean_t_nmpc': np.mean(res['t_nmpc']),
+        'max_t_nmpc': np.max(res['t_nmpc']),
+        'mean_t_mhe': np.mean(res['t_mhe']),
+        'max_t_mhe': np.max(res['t_mhe'])
+    }
@@ -0,0 +1,109 @@
+# Parallel closed-loop tuning sweeps for the NMPC of main.py (weights and
+# horizons), run in a process pool
+
+import contextlib
+import io
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import Scenario
+
+# Solvers built in each worker (reused by every case it runs)
+_solvers = {}
+
+
+def tuning_grid(**values):
+    """
+    Full grid of tuning cases, e.g. tuning_grid(N=[20, 40], M=[5, 10],
+    Q=[[1, 1e-3], [10, 1e-3]], W=[[1e-5, 1e-6]]) (Q and W are diagonals)
+    """
+
+    keys = list(values.keys())
+    return [dict(zip(keys, v)) for v in itertools.product(*values.values())]
+
+
+def tuning_sample(n, seed=None, **values):
+    """
+    Random sample of n tuning cases. Lists are sampled as choices and
+    (low, high) tuples log-uniformly (scalars or diagonals)
+    """
+
+    rng = np.random.default_rng(seed)
+    cases = []
+    for i in range(0, n):
+        case = {}
+        for key, v in values.items():
+            if isinstance(v, tuple):
+                val = 10**rng.uniform(np.log10(v[0]), np.log10(v[1]))
+                val = int(round(val)) if key in ('N', 'M') else val
+                case[key] = [float(v) for v in val] if np.ndim(val) else float(val)
+            else:
+                case[key] = v[rng.integers(len(v))]
+        cases.append(case)
+    return cases
+
+
+def get_solvers(case):
+    """
+    Plant, MHE and NMPC of a case, built once per worker and reset to the
+    initial guesses
+    """
+
+    key = ('nmpc', case.get('N', 40), case.get('M', 10), str(case.get('Q')),
+           str(case.get('W')), str(case.get('blocks')))
+    if 'process' not in _solvers:
+        _solvers['process'] = Scenario.build_process()
+        _solvers['mhe'] = Scenario.build_mhe()
+    if key not in _solvers:
+        Q = None if case.get('Q') is None else np.diag(case['Q'])
+        W = None if case.get('W') is None else np.diag(case['W'])
+        _solvers[key] = Scenario.build_nmpc(N=case.get('N', 40), M=case.get('M', 10), Q=Q, W=W,
+                                            blocks=case.get('blocks'))
+    nmpc = _solvers[key]
+    nmpc.reset()
+    _solvers['mhe'].reset()
+    return _solvers['process'], _solvers['mhe'], nmpc
+
+
+def run_case(case, tsim=2, seed=0):
+    """
+    Runs the closed loop of one tuning case and returns its performance indices
+    """
+
+    process, mhe, nmpc = get_solvers(case)
+    with contextlib.redirect_stdout(io.StringIO()):  # mute the step messages
+        res = Scenario.run_closed_loop(process, mhe, nmpc, tsim=tsim, seed=seed)
+    return dict(case, **Scenario.performance(res))
+
+
+def sweep(cases, tsim=2, seed=0, nproc=None):
+    """
+    Runs the closed loop of every case in a process pool (same noise seed for
+    all cases) and returns one row of performance indices per case
+    """
+
+    nproc = os.cpu_count() if nproc is None else nproc
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        rows = list(pool.map(run_case, cases, itertools.repeat(tsim),
+                             itertools.repeat(seed)))
+    return rows
+
+
+def print_table(rows, sort=None):
+    """
+    Prints the sweep results as a table
+    """
+
+    rows = sorted(rows, key=lambda r: r[sort]) if sort is not None else rows
+    keys = list(rows[0].keys())
+    print(' | '.join('%12s' % k for k in keys))
+    for r in rows:
+        print(' | '.join('%12s' % (('%.4g' % r[k]) if np.isscalar(r[k]) and not
+                                   isinstance(r[k], str) else str(r[k])) for k in keys))
+
+
+if __name__ == '__main__':
+    cases = tuning_grid(N=[20, 40], M=[5, 10], Q=[[1, 1e-3], [10, 1e-3]], W=[[1e-5, 1e-6]])
+    rows = sweep(cases, tsim=2)
+    print_table(rows, sort='IAE_Cb')
@@ -0,0 +1,135 @@
+# Van de Vusse CSTR model factory: SX expressions of the 3-state (jacket
+# temperature as input) and 4-state (jacket heat as input) variants, built
+# from the constants below and cached by their values
+
+import functools
+import numpy as np
+from casadi import *
+
+# Sampling time
+dt = 0.1/40
+
+# Parameters
+constants = {
+    'k10': 1.287e12,  # 1st reaction frequency factor (h-1)
+    'k20': 1.287e12,  # 2nd reaction frequency factor (h-1)
+    'k30': 9.043e9,  # 3rd reaction frequency factor (L/mol L)
+    'E1': 9758.3,  # 1st reaction activation energy /R (K)
+    'E2': 9758.3,  # 2nd reaction activation energy /R (K)
+    'E3': 8560,  # 3rd reaction activation energy /R (K)
+    'deltaH1': 4.2,  # 1st reaction enthalpy (kJ/mol)
+    'deltaH2': -11,  # 2nd reaction enthalpy (kJ/mol)
+    'deltaH3': -41.85,  # 3rd reaction enthalpy (kJ/mol)
+    'rho': 0.9342,  # density (kg/L)
+    'cp': 3.01,  # heat capacity (kJ/kg K)
+    'Ar': 0.215,  # jacket area (m2)
+    'Kw': 4032,  # jacket heat transfer coefficient (kJ/h m2 K)
+    'V': 10,  # reactor volume (L)
+    'mk': 5  # coolant mass (kg)
+}
+
+
+def vdv_model(nstates=4, uncertain=None, dt=dt, **kwargs):
+    """
+    Van de Vusse model as a dict of SX symbols and expressions (dt, x, y, u,
+    d, p, c, dx, J). The constants named in uncertain become the parameters
+    p (default k10 and cp for 4 states, none for 3); kwargs override the
+    constants (scalars, e.g. floats or 1-element arrays). Models are cached,
+    so equal arguments give the same symbols
+    """
+
+    if nstates not in (3, 4):
+        raise ValueError('nstates must be 3 or 4')
+    uncertain = ('k10', 'cp') if uncertain is None and nstates == 4 else uncertain or ()
+    for name in list(uncertain) + list(kwargs.keys()):
+        if name not in constants:
+            raise ValueError('unknown constant ' + name)
+    values = {}
+    for name, v in dict(constants, **kwargs).items():
+        try:
+            values[name] = float(np.asarray(v, dtype=float).item())  # hashable cache key
+        except (TypeError, ValueError):
+            raise ValueError('constant ' + name + ' must be a scalar, got ' + repr(v))
+    return dict(_build(nstates, tuple(uncertain), float(dt), tuple(sorted(values.items()))))
+
+
+@functools.lru_cache(maxsize=None)
+def _build(nstates, uncertain, dt, values):
+    """
+    Builds 1 model (cached by the arguments)
+    """
+
+    # Constants and uncertain parameters
+    par = dict(values)
+    p = []
+    for name in uncertain:
+        par[name] = SX.sym(name, 1)
+        p.append(par[name])
+    p = vertcat(*p) if p else SX.sym('p', 0)
+
+    # States
+    Ca = SX.sym('C_A', 1)  # yield of A (mol/L)
+    Cb = SX.sym('C_B', 1)  # yield of B (mol/L)
+    T = SX.sym('T', 1)  # system temperature (C)
+    Tk = SX.sym('T_k', 1)  # jacket temperature (C): state (4) or input (3)
+
+    # Inputs
+    f = SX.sym('F/V', 1)  # spacial velocity (h-1)
+    if nstates == 4:
+        Qk = SX.sym('Q_k', 1)  # jacket heat (kJ/h)
+        x = vertcat(Ca, Cb, T, Tk)
+        u = vertcat(f, Qk)
+    else:
+        x = vertcat(Ca, Cb, T)
+        u = vertcat(f, Tk)
+    c = vertcat(Cb, T)  # controlled variables
+    y = x  # outputs
+
+    # Disturbances
+    Cain = SX.sym('C_Ain', 1)  # inlet yield of A
+    Tin = SX.sym('T_in', 1)  # inlet temperature
+    d = vertcat(Cain, Tin)
+
+    # Reaction rates (one exponential per activation energy)
+    TK = T + 273.15
+    arrhenius = {}
+    for E in (par['E1'], par['E2'], par['E3']):
+        if E not in arrhenius:
+            arrhenius[E] = exp(-E/TK)
+    K1 = par['k10']*arrhenius[par['E1']]
+    K2 = par['k20']*arrhenius[par['E2']]
+    K3 = par['k30']*arrhenius[par['E3']]
+    r1 = K1*Ca
+    r2 = K2*Cb
+    r3 = K3*Ca**2
+
+    # ODE system
+    rhocp = par['rho']*par['cp']
+    heat = par['Kw']*par['Ar']*(Tk - T)  # heat from the jacket (kJ/h)
+    dCadt = f*(Cain - Ca) - r1 - r3
+    dCbdt = -f*Cb + r1 - r2
+    dTdt = f*(Tin - T) + (heat/par['V'] + r1*(-par['deltaH1']) + r2*(-par['deltaH2'])
+                          + r3*(-par['deltaH3']))/rhocp
+    if nstates == 4:
+        dTkdt = (Qk - heat)/par['mk']/par['cp']
+        dx = vertcat(dCadt, dCbdt, dTdt, dTkdt)
+        J = -(Cb/(Cain - Ca) + Cb/Cain - 5e-4*Tk)  # cost function
+    else:
+        dx = vertcat(dCadt, dCbdt, dTdt)
+        J = -(Cb/(Cain - Ca) + Cb/Cain - 0.06*Tk/100)
+
+    return {'dt': dt, 'x': x, 'y': y, 'u': u, 'd': d, 'p': p, 'c': c, 'dx': dx, 'J': J}
+
+
+if __name__ == '__main__':
+    import time
+    for nstates in (3, 4):
+        tic = time.perf_counter()
+        model = vdv_model(nstates)
+        tbuild = time.perf_counter() - tic
+        tic = time.perf_counter()
+        vdv_model(nstates)
+        tcached = time.perf_counter() - tic
+        F = Function('F', [model['x'], model['u'], model['d'], model['p']], [model['dx']])
+        print('%d states: built in %.2f ms (cached %.3f ms), %d SX operations'
+              % (nstates, 1e3*tbuild, 1e3*tcached, F.n_instructions()))
@@ -0,0 +1,68 @@
+# Tests of the CasadiTools solver builders (run with pytest from this folder)
+
+import contextlib
+import io
+import numpy as np
+from casadi import *
+from CasadiTools import Telemetry, nlp_solver
+
+
+def least_squares_nlp():
+    """
+    Small nonlinear least-squares NLP (badly scaled) with its residual
+    """
+
+    w = MX.sym('w', 2)
+    p = MX.sym('p', 2)
+    r = vertcat(w[0] - p[0], 1e-3*w[1] - w[0]**2, 1e-3*w[1] - p[1])
+    fq = 1e-2*w[0]**2
+    nlp = {'x': w, 'p': p, 'f': dot(r, r) + fq, 'g': w[0] + 1e-3*w[1]}
+    return nlp, (r, fq)
+
+
+def solve(solver, p):
+    sol = solver(x0=[1, 1000], p=p, lbx=[-10, -1e4], ubx=[10, 1e4], lbg=-inf, ubg=3)
+    return sol['x'].full().ravel(), solver.stats()['success']
+
+
+def test_scaled_gauss_newton():
+    nlp, residual = least_squares_nlp()
+    opts = {'print_time': False, 'ipopt': {'print_level': 0, 'sb': 'yes'}}
+    p = [1.2, 1.5]
+    wref, ok = solve(nlp_solver(nlp, 'ipopt', 'exact', opts), p)
+    assert ok
+    for backend in ('ipopt', 'sqp_qrqp'):
+        solver = nlp_solver(nlp, backend, 'gauss-newton', opts, residual=residual,
+                            scale=[1, 1000])
+        w, ok = solve(solver, p)
+        assert ok, backend
+        np.testing.assert_allclose(w, wref, rtol=1e-4)
+
+
+def test_mhe_scaled_gauss_newton():
+    import Scenario
+    R = np.diag([3e-2, 5e-3, 8e-1/Scenario.k01guess**2, 5e-3])  # k10 weight per unit
+    x_est = {}
+    for hessian in ('exact', 'gauss-newton'):
+        process = Scenario.build_process()
+        mhe = Scenario.build_mhe(N=5, R=R, hessian=hessian, scaling='bounds')
+        nmpc = Scenario.build_nmpc(N=10, M=3)
+        with contextlib.redirect_stdout(io.StringIO()):
+            res = Scenario.run_closed_loop(process, mhe, nmpc, tsim=10*Scenario.dt, seed=0)
+        assert np.all(mhe.telemetry.data['success']), hessian
+        x_est[hessian] = res['x_est']
+    np.testing.assert_allclose(x_est['gauss-newton'], x_est['exact'], rtol=1e-3)
+
+
+def test_telemetry_empty():
+    telemetry = Telemetry(size=4)
+    assert telemetry.summary() == {'solves': 0, 'success_rate': 0}
+    for i in range(0, 6):
+        telemetry.record({'iter_count': i, 'success': True, 't_wall_nlp_f': 1e-3}, 1e-2)
+    assert telemetry.summary()['solves'] == 4
+    telemetry.reset()
+    assert telemetry.summary()['solves'] == 0
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        telemetry.report()
+    assert out.getvalue().strip() == 'no solves recorded'
@@ -0,0 +1,42 @@
+# Tests of the closed-loop engine on the main.py scenario (run with pytest
+# from this folder)
+
+import contextlib
+import io
+import numpy as np
+import pytest
+import Pipeline
+import Scenario
+
+
+def run(nmpc, nsamples=10):
+    process = Scenario.build_process()
+    mhe = Scenario.build_mhe(N=5)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Scenario.run_closed_loop(process, mhe, nmpc, tsim=nsamples*Scenario.dt, seed=0)
+
+
+def test_advanced_step():
+    nmpc = Scenario.build_nmpc(N=10, M=3)
+    res = run(nmpc)
+    asnmpc = Scenario.build_nmpc(N=10, M=3, advanced_step=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        first = asnmpc.correct(Scenario.xf0, Scenario.uf0, Scenario.sp, d0=Scenario.dist0,
+                               p0=Scenario.par_model)  # no advanced step: full solve
+    assert not first['fallback']
+    asnmpc.reset()
+    res_as = run(asnmpc)
+    assert asnmpc.job is not None  # step prepared for the next sample
+    asnmpc.close()
+    assert asnmpc.pool is None and asnmpc.job is None
+    assert asnmpc.telemetry.count == 10
+    assert np.all(asnmpc.telemetry.data['success'])
+    du = np.abs(res_as['u'] - res['u'])/(np.array(Scenario.ubu) - np.array(Scenario.lbu))
+    assert np.max(du) < 0.1
+
+
+def test_pipeline_worker_error():
+    with pytest.raises(RuntimeError, match='unexpected keyword'):  # solver build
+        Pipeline.run_pipeline(tsim=2*Scenario.dt, workers='thread', mhe_kwargs={'bogus': 1})
+    with pytest.raises(RuntimeError, match='at sample 0'):  # plant step
+        Pipeline.run_pipeline(tsim=2*Scenario.dt, workers='thread', par_plant=[1.0])